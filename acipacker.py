@@ -1,37 +1,1493 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 import argparse
-import email.utils
+import bz2
+import codecs
+import collections
+import contextlib
+import copy
+import fcntl
+import functools
 import glob
+import gzip
+import hashlib
+import io
 import os
 import os.path
 import json
+import queue
+import re
+import multiprocessing
 import shutil
+import signal
+import stat
+import struct
 import subprocess
+import sys
 import tempfile
+import traceback
+import tarfile
+import threading
 import time
+import zlib
+from multiprocessing.pool import ThreadPool
+from urllib.error import HTTPError
+from urllib.request import Request
+from urllib.request import urlopen
 
 try:
-    # python3
-    from urllib.request import urlopen
-    from urllib.request import Request
-except:
-    # python2
-    from urllib2 import urlopen
-    from urllib2 import Request
-    FileNotFoundError = IOError
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
 
 MAGIC_KEY = '-aci-packer-build-steps-'
+BARRIER_STEPS = ('image', 'setup_chroot', 'ansible', 'cmd', 'shell',
+                 'ldsocache', 'pycompile')
+PYCOMPILE_MODES = ('timestamp', 'checked-hash', 'unchecked-hash')
+PYCOMPILE_SCRIPT = r'''
+import json, os, py_compile, struct, sys
+try:
+    import importlib.util as util
+    cache_from_source, magic = util.cache_from_source, util.MAGIC_NUMBER
+except (ImportError, AttributeError):
+    import imp
+    cache_from_source, magic = imp.cache_from_source, imp.get_magic()
+levels, mode = [int(x) for x in sys.argv[1].split(',')], sys.argv[2]
+kwargs = {}
+if sys.version_info >= (3, 7):
+    kwargs['invalidation_mode'] = getattr(
+        py_compile.PycInvalidationMode, mode.upper().replace('-', '_'))
+elif mode != 'timestamp':
+    sys.exit('hash-based pycs require Python 3.7 or later')
+
+def cache_path(path, level):
+    if sys.version_info >= (3, 5):
+        return cache_from_source(path, optimization=level or '')
+    return cache_from_source(path, debug_override=not level)
+
+def is_stale(path, cfile):
+    try:
+        with open(cfile, 'rb') as f:
+            head = f.read(16)
+    except (IOError, OSError):
+        return True
+    if head[:4] != magic:
+        return True
+    st = os.stat(path)
+    stamp = struct.pack('<II', int(st.st_mtime) & 0xFFFFFFFF,
+                        st.st_size & 0xFFFFFFFF)
+    if sys.version_info < (3, 7):
+        return head[4:12] != stamp[:8 if sys.version_info >= (3, 3) else 4]
+    flags = struct.unpack('<I', head[4:8])[0]
+    if mode == 'timestamp':
+        return flags != 0 or head[8:16] != stamp
+    if flags != (3 if mode == 'checked-hash' else 1):
+        return True
+    with open(path, 'rb') as f:
+        return head[8:16] != util.source_hash(f.read())
+
+result = {'compiled': 0, 'fresh': 0, 'failed': []}
+for path in sys.stdin.read().splitlines():
+    for level in levels:
+        cfile = cache_path(path, level)
+        if not is_stale(path, cfile):
+            result['fresh'] += 1
+            continue
+        try:
+            py_compile.compile(path, cfile, doraise=True, optimize=level,
+                               **kwargs)
+            result['compiled'] += 1
+        except (py_compile.PyCompileError, IOError, OSError) as e:
+            result['failed'].append('{0}: {1}'.format(path, e))
+sys.stdout.write(json.dumps(result))
+'''
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.cache/aci-packer')
+
+
+def _compress_gzip(data):
+    c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
+
+
+def _compress_xz(data):
+    if lzma is None:
+        raise ValueError('xz compression requires lzma module')
+    return lzma.compress(data, format=lzma.FORMAT_XZ, preset=6)
+
+
+def _compress_bzip2(data):
+    return bz2.compress(data, 9)
+
+
+def _compress_zstd(data):
+    if zstandard is None:
+        raise ValueError('zstd compression requires zstandard module')
+    return zstandard.ZstdCompressor(level=3).compress(data)
+
+
+def _compress_lz4(data):
+    if lz4 is None:
+        raise ValueError('lz4 compression requires lz4 module')
+    return lz4.frame.compress(data)
+
+# compression name -> (block compressor, block size)
 COMPRESSION_TYPE = {
-    'none': '',
-    'xz': 'J',
-    'gzip': 'z',
-    'bzip2': 'j'
+    'none': (None, 1 << 20),
+    'gzip': (_compress_gzip, 1 << 20),
+    'xz': (_compress_xz, 8 << 20),
+    'bzip2': (_compress_bzip2, 900 * 1000),
+    'zstd': (_compress_zstd, 4 << 20),
+    'lz4': (_compress_lz4, 4 << 20),
+}
+
+
+def _decompress_block(compression, data):
+    if compression == 'gzip':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if compression == 'xz':
+        if lzma is None:
+            raise ValueError('xz compression requires lzma module')
+        return lzma.decompress(data, format=lzma.FORMAT_XZ)
+    if compression == 'bzip2':
+        return bz2.decompress(data)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compression requires zstandard module')
+        return zstandard.ZstdDecompressor().decompress(data)
+    if compression == 'lz4':
+        if lz4 is None:
+            raise ValueError('lz4 compression requires lz4 module')
+        return lz4.frame.decompress(data)
+    return data
+
+
+ELF_MAGIC = b'\x7fELF'
+PT_LOAD, PT_DYNAMIC, PT_INTERP = 1, 2, 3
+FICLONE = 0x40049409
+DT_NULL, DT_NEEDED, DT_STRTAB, DT_SONAME, DT_RPATH, DT_RUNPATH = \
+    0, 1, 5, 14, 15, 29
+LD_SO_CACHE_MAGIC_OLD = b'ld.so-1.7.0'
+LD_SO_CACHE_MAGIC_NEW = b'glibc-ld.so.cache1.1'
+LD_SO_CACHE_FLAGS = {
+    (3, 1): 0x0003,     # i386
+    (20, 1): 0x0003,    # ppc
+    (21, 2): 0x0503,    # ppc64
+    (22, 2): 0x0403,    # s390x
+    (62, 1): 0x0803,    # x32
+    (62, 2): 0x0303,    # x86-64
+    (183, 2): 0x0a03,   # aarch64
 }
+LD_SO_SYSTEM_DIRS = ['/lib', '/usr/lib', '/lib64', '/usr/lib64']
+
+
+class ElfInfo(object):
+    def __init__(self, elf_class, machine, interp, needed, soname,
+                 rpath, runpath, flags=0):
+        self.elf_class = elf_class
+        self.machine = machine
+        self.flags = flags
+        self.interp = interp
+        self.needed = needed
+        self.soname = soname
+        self.rpath = rpath
+        self.runpath = runpath
+
+    @classmethod
+    def parse(cls, path):
+        with open(path, 'rb') as f:
+            ident = f.read(16)
+            if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+                return None
+            elf_class = ord(ident[4:5])
+            endian = {1: '<', 2: '>'}.get(ord(ident[5:6]))
+            if elf_class not in (1, 2) or not endian:
+                return None
+            if elf_class == 1:
+                ehdr, phdr, dyn = 'HHIIIIIHHHHHH', 'IIIIIIII', 'iI'
+            else:
+                ehdr, phdr, dyn = 'HHIQQQIHHHHHH', 'IIQQQQQQ', 'qQ'
+            ehdr, phdr, dyn = [struct.Struct(endian + x)
+                               for x in (ehdr, phdr, dyn)]
+            data = f.read(ehdr.size)
+            if len(data) < ehdr.size:
+                return None
+            (_, machine, _, _, phoff, _, flags, _,
+             phentsize, phnum, _, _, _) = ehdr.unpack(data)
+            loads, interp, dynamic = [], None, None
+            f.seek(phoff)
+            table = f.read(phentsize * phnum)
+            for i in range(phnum):
+                entry = table[i * phentsize:i * phentsize + phdr.size]
+                if len(entry) < phdr.size:
+                    return None
+                if elf_class == 1:
+                    p_type, offset, vaddr, _, filesz = phdr.unpack(entry)[:5]
+                else:
+                    p_type, _, offset, vaddr, _, filesz = \
+                        phdr.unpack(entry)[:6]
+                if p_type == PT_LOAD:
+                    loads.append((vaddr, offset, filesz))
+                elif p_type == PT_INTERP:
+                    f.seek(offset)
+                    interp = f.read(filesz).split(b'\0')[0].decode('utf-8')
+                elif p_type == PT_DYNAMIC:
+                    dynamic = (offset, filesz)
+
+            def vaddr_to_offset(addr):
+                for vaddr, offset, filesz in loads:
+                    if vaddr <= addr < vaddr + filesz:
+                        return addr - vaddr + offset
+                return None
+
+            needed, soname, rpath, runpath = [], None, None, None
+            if dynamic:
+                f.seek(dynamic[0])
+                data = f.read(dynamic[1])
+                entries = []
+                for i in range(len(data) // dyn.size):
+                    tag, val = dyn.unpack_from(data, i * dyn.size)
+                    if tag == DT_NULL:
+                        break
+                    entries.append((tag, val))
+                strtab = [v for t, v in entries if t == DT_STRTAB]
+                strtab = vaddr_to_offset(strtab[0]) if strtab else None
+                if strtab is not None:
+                    def read_str(off):
+                        f.seek(strtab + off)
+                        buf = b''
+                        while b'\0' not in buf:
+                            chunk = f.read(256)
+                            if not chunk:
+                                break
+                            buf += chunk
+                        return buf.split(b'\0')[0].decode('utf-8')
+                    for tag, val in entries:
+                        if tag == DT_NEEDED:
+                            needed.append(read_str(val))
+                        elif tag == DT_SONAME:
+                            soname = read_str(val)
+                        elif tag == DT_RPATH:
+                            rpath = read_str(val)
+                        elif tag == DT_RUNPATH:
+                            runpath = read_str(val)
+        return cls(elf_class, machine, interp, needed, soname, rpath, runpath,
+                   flags)
+
+
+def _read_ld_so_conf(path, root='/'):
+    dirs = []
+    configs = [path]
+    while len(configs) > 0:
+        config_path = configs[0]
+        configs = configs[1:]
+        try:
+            f = open(os.path.abspath(root + '/' + config_path), 'r')
+        except (IOError, OSError):
+            continue
+        with f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if len(line) == 0:
+                    continue
+                if line[0] == '/' and os.path.exists(root + '/' + line):
+                    dirs.append(line)
+                if line.startswith('include '):
+                    line = os.path.join(
+                        os.path.dirname(config_path), line[8:].strip())
+                    configs += sorted(
+                        x[len(root.rstrip('/')):] for x in
+                        glob.glob(os.path.abspath(root + '/' + line)))
+    return dirs
+
+
+def _parse_ld_so_cache(data):
+    entries = []
+    if data.startswith(LD_SO_CACHE_MAGIC_OLD):
+        nlibs = struct.unpack_from('=I', data, 12)[0]
+        offset = 16 + nlibs * 12
+        new_offset = (offset + 7) & ~7
+        if data[new_offset:new_offset + 20] != LD_SO_CACHE_MAGIC_NEW:
+            for i in range(nlibs):
+                flags, key, value = struct.unpack_from('=iII', data,
+                                                       16 + i * 12)
+                entries.append((flags, offset + key, offset + value))
+        else:
+            data = data[new_offset:]
+    if not entries:
+        if not data.startswith(LD_SO_CACHE_MAGIC_NEW):
+            return []
+        nlibs = struct.unpack_from('=I', data, 20)[0]
+        for i in range(nlibs):
+            flags, key, value, _, _ = struct.unpack_from('=iIIIQ', data,
+                                                         48 + i * 24)
+            entries.append((flags, key, value))
+
+    def read_str(off):
+        return data[off:data.index(b'\0', off)].decode('utf-8')
+    return [(flags, read_str(key), read_str(value))
+            for flags, key, value in entries]
+
+
+_ld_so_cache_memo = {}
+
+
+def _load_ld_so_cache(path='/etc/ld.so.cache'):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return []
+    key = (path, st.st_ino, st.st_mtime)
+    if key not in _ld_so_cache_memo:
+        try:
+            with open(path, 'rb') as f:
+                entries = _parse_ld_so_cache(f.read())
+        except (IOError, OSError, ValueError, struct.error):
+            entries = []
+        _ld_so_cache_memo[key] = entries
+    return _ld_so_cache_memo[key]
+
+
+def _dl_cache_libcmp(a, b):
+    i = j = 0
+    while i < len(a):
+        if a[i].isdigit():
+            if j >= len(b) or not b[j].isdigit():
+                return 1
+            m, n = i, j
+            while i < len(a) and a[i].isdigit():
+                i += 1
+            while j < len(b) and b[j].isdigit():
+                j += 1
+            if int(a[m:i]) != int(b[n:j]):
+                return int(a[m:i]) - int(b[n:j])
+        elif j < len(b) and b[j].isdigit():
+            return -1
+        elif j >= len(b) or a[i] != b[j]:
+            return ord(a[i]) - (ord(b[j]) if j < len(b) else 0)
+        else:
+            i += 1
+            j += 1
+    return -ord(b[j]) if j < len(b) else 0
+
+
+def _ld_so_cache_flag(info):
+    if info.machine == 40:
+        if info.flags & 0x400:
+            return 0x0903
+        return 0x0b03 if info.flags & 0x200 else 0x0003
+    if info.machine == 243 and info.elf_class == 2:
+        return 0x1003 if info.flags & 0x4 else 0x0f03
+    return LD_SO_CACHE_FLAGS.get((info.machine, info.elf_class), 0x0003)
+
+
+def _ld_so_system_dirs(root):
+    dirs = []
+    for d in LD_SO_SYSTEM_DIRS:
+        if d.endswith('64'):
+            path = root + _resolve_in_root(root, d)
+            names = os.listdir(path) if os.path.isdir(path) else []
+            if all(x.startswith('ld-') for x in names):
+                continue
+        dirs.append(d)
+    return dirs
+
+
+def _scan_ld_so_dirs(root, dirs, load=ElfInfo.parse, links=True):
+    entries, seen = [], set()
+    for d in dirs:
+        d = '/' + os.path.normpath(d).lstrip('/')
+        real = _resolve_in_root(root, d)
+        if real in seen or not os.path.isdir(root + real):
+            continue
+        seen.add(real)
+        libs = collections.OrderedDict()
+        for name in sorted(os.listdir(root + real)):
+            if not name.startswith(('lib', 'ld-')) or '.so' not in name:
+                continue
+            path = _resolve_in_root(root, real + '/' + name)
+            if not os.path.isfile(root + path):
+                continue
+            info = load(root + path)
+            if info is None:
+                continue
+            soname = info.soname or name
+            is_link = os.path.islink(os.path.join(root + real, name)) and (
+                name == soname or (name.endswith('.so') and
+                                   soname.startswith(name)))
+            if is_link:
+                soname = name
+            old = libs.get(soname)
+            if old is None or (not is_link and old[1]) or (
+                    is_link == old[1] and _dl_cache_libcmp(old[0], name) < 0):
+                libs[soname] = (name, is_link, _ld_so_cache_flag(info))
+        for soname, (name, is_link, flag) in libs.items():
+            link = os.path.join(root + real, soname)
+            if links and not is_link and name != soname and (
+                    not os.path.lexists(link) or
+                    (os.path.islink(link) and os.readlink(link) != name)):
+                if os.path.lexists(link):
+                    os.unlink(link)
+                os.symlink(name, link)
+            entries.append((flag, soname, d + '/' + soname))
+    return entries
+
+
+def _make_ld_so_cache(entries):
+    def compare(a, b):
+        return _dl_cache_libcmp(b[1], a[1]) or b[0] - a[0]
+    entries = sorted(entries, key=functools.cmp_to_key(compare))
+    offset = 48 + len(entries) * 24
+    strings, table, libs = {}, [], []
+    def add(value):
+        if value not in strings:
+            strings[value] = offset + sum(len(x) for x in table)
+            table.append(value.encode('utf-8') + b'\0')
+        return strings[value]
+    for flags, name, path in entries:
+        libs.append(struct.pack('=iIIIQ', flags, add(name), add(path), 0, 0))
+    table = b''.join(table)
+    header = struct.pack('=20sIIB3sI12s', LD_SO_CACHE_MAGIC_NEW,
+                         len(entries), len(table),
+                         2 if sys.byteorder == 'little' else 3,
+                         b'', 0, b'')
+    return header + b''.join(libs) + table
+
+
+class Tracer(object):
+    def __init__(self, path=None, format='jsonl'):
+        self.path = path
+        self.format = format
+        self.enabled = path is not None
+        self.events = []
+        self.counters = collections.Counter()
+        self.sources = []
+        self.lock = threading.Lock()
+        self.origin = time.time()
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] += n
+
+    def snapshot(self):
+        with self.lock:
+            counters = collections.Counter(self.counters)
+        for source in self.sources:
+            counters.update(source())
+        return counters
+
+    @contextlib.contextmanager
+    def span(self, name, cat, **args):
+        if not self.enabled:
+            yield args
+            return
+        start, times, counters = time.time(), os.times(), self.snapshot()
+        try:
+            yield args
+        finally:
+            end, times2, counters2 = time.time(), os.times(), self.snapshot()
+            counters2.subtract(counters)
+            if 'bytes_in' in args and end > start:
+                args['throughput'] = args['bytes_in'] / (end - start)
+            event = {
+                'name': name, 'cat': cat,
+                'start': start - self.origin, 'wall': end - start,
+                'cpu': (times2[0] + times2[1]) - (times[0] + times[1]),
+                'subprocess': (times2[2] + times2[3]) - (times[2] + times[3]),
+                'thread': threading.current_thread().name,
+                'counters': dict((k, v) for k, v in counters2.items() if v),
+                'args': args,
+            }
+            with self.lock:
+                self.events.append(event)
+
+    def write(self):
+        if not self.enabled:
+            return
+        events = sorted(self.events, key=lambda e: e['start'])
+        with open(self.path, 'w') as f:
+            if self.format == 'jsonl':
+                for event in events:
+                    f.write(json.dumps(event, sort_keys=True) + '\n')
+                return
+            threads = {}
+            trace = []
+            for event in events:
+                args = dict(event['args'])
+                args.update(event['counters'])
+                args.update({'cpu': event['cpu'],
+                             'subprocess': event['subprocess']})
+                trace.append({
+                    'name': event['name'], 'cat': event['cat'], 'ph': 'X',
+                    'ts': int(event['start'] * 1e6),
+                    'dur': int(event['wall'] * 1e6),
+                    'pid': os.getpid(),
+                    'tid': threads.setdefault(event['thread'], len(threads)),
+                    'args': args})
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+
+def _kill_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+class StepOutput(object):
+    LINE_MAX = 1024
+
+    def __init__(self, path=None, tail=20, echo=None, timeout=None,
+                 max_bytes=16 << 20, backups=2):
+        self.path = path
+        self.lines = collections.deque(maxlen=max(tail, 1))
+        self.partial = b''
+        self.echo = echo
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.timeout = timeout
+        self.expired = False
+        self.procs = []
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = None
+        self.size = 0
+        self.lock = threading.Lock()
+        if path:
+            _makedirs(os.path.dirname(path))
+            for p in [path] + self._backup_paths():
+                if os.path.exists(p):
+                    os.unlink(p)
+
+    def _backup_paths(self):
+        return ['{0}.{1}'.format(self.path, i)
+                for i in range(1, self.backups + 1)]
+
+    def _rotate(self):
+        self.file.close()
+        paths = [self.path] + self._backup_paths()
+        for src, dst in reversed(list(zip(paths, paths[1:]))):
+            if os.path.exists(src):
+                os.rename(src, dst)
+        self.file = open(self.path, 'wb')
+        self.size = 0
+
+    def write(self, data):
+        with self.lock:
+            if self.path:
+                if self.file is None:
+                    self.file = open(self.path, 'wb')
+                elif self.size and self.size + len(data) > self.max_bytes:
+                    self._rotate()
+                self.file.write(data)
+                self.size += len(data)
+            if self.echo:
+                self.echo.write(self.decoder.decode(data))
+                self.echo.flush()
+            lines = (self.partial + data).replace(b'\r', b'\n').split(b'\n')
+            self.partial = lines.pop()[-self.LINE_MAX:]
+            for line in lines:
+                if line.strip():
+                    self.lines.append(line[:self.LINE_MAX])
+
+    def track(self, proc):
+        with self.lock:
+            self.procs.append(proc)
+            expired = self.expired
+        if expired:
+            _kill_group(proc)
+
+    def expire(self):
+        with self.lock:
+            self.expired = True
+            procs = list(self.procs)
+        for proc in procs:
+            if proc.poll() is None:
+                _kill_group(proc)
+
+    def tail(self):
+        with self.lock:
+            lines = list(self.lines)
+            if self.partial.strip():
+                lines = (lines + [self.partial])[-self.lines.maxlen:]
+        return [x.decode('utf-8', 'replace') for x in lines]
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+
+class ElfResolver(object):
+    def __init__(self, ld_so_cache='/etc/ld.so.cache',
+                 ld_so_conf='/etc/ld.so.conf'):
+        self.ld_so_cache_path = ld_so_cache
+        self.ld_so_conf_path = ld_so_conf
+        self.elf_cache = {}
+        self.lookup_cache = {}
+        self._ld_so_cache = None
+        self._ld_so_conf = None
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = (path, st.st_ino, st.st_mtime)
+        if key in self.elf_cache:
+            self.hits += 1
+            return self.elf_cache[key]
+        self.misses += 1
+        info = None
+        if os.path.isfile(path):
+            try:
+                info = ElfInfo.parse(path)
+            except (IOError, OSError, ValueError, struct.error):
+                info = None
+        self.elf_cache[key] = info
+        return info
+
+    def ld_so_cache(self):
+        if self._ld_so_cache is None:
+            cache = {}
+            for _, name, path in _load_ld_so_cache(self.ld_so_cache_path):
+                cache.setdefault(name, []).append(path)
+            self._ld_so_cache = cache
+        return self._ld_so_cache
+
+    def ld_so_conf(self):
+        if self._ld_so_conf is None:
+            self._ld_so_conf = _read_ld_so_conf(self.ld_so_conf_path)
+        return self._ld_so_conf
+
+    def resolve(self, path):
+        root = self.load(path)
+        if root is None:
+            return set()
+        libs = set()
+        loaded = {}
+        interp_path = root.interp or self._default_interp(root)
+        if root.interp:
+            libs.add(root.interp)
+        if interp_path:
+            loaded[os.path.basename(interp_path)] = interp_path
+            interp = self.load(interp_path)
+            if interp and interp.soname:
+                loaded[interp.soname] = interp_path
+        queue = [(path, root, [])]
+        while queue:
+            obj_path, obj, loaders = queue.pop(0)
+            chain = [(obj_path, obj)] + loaders
+            for name in obj.needed:
+                if name in loaded:
+                    if loaded[name]:
+                        libs.add(loaded[name])
+                    continue
+                lib_path = self._search(name, obj, chain)
+                loaded[name] = lib_path
+                if lib_path is None:
+                    continue
+                lib = self.load(lib_path)
+                libs.add(lib_path)
+                if lib.soname:
+                    loaded.setdefault(lib.soname, lib_path)
+                queue.append((lib_path, lib, chain))
+        return libs
+
+    def _search(self, name, obj, chain):
+        if '/' in name:
+            return name if self._compatible(name, obj) else None
+        dirs = []
+        if not obj.runpath:
+            for loader_path, loader in chain:
+                if loader.rpath and not loader.runpath:
+                    dirs += self._expand(loader.rpath, loader_path, loader)
+        if os.environ.get('LD_LIBRARY_PATH'):
+            dirs += os.environ['LD_LIBRARY_PATH'].replace(';', ':').split(':')
+        if obj.runpath:
+            dirs += self._expand(obj.runpath, chain[0][0], obj)
+        key = (name, tuple(dirs), obj.elf_class, obj.machine)
+        if key in self.lookup_cache:
+            return self.lookup_cache[key]
+        candidates = [os.path.join(d, name) for d in dirs if d]
+        candidates += self.ld_so_cache().get(name, [])
+        if obj.elf_class == 2:
+            default_dirs = ['/lib64', '/usr/lib64', '/lib', '/usr/lib']
+        else:
+            default_dirs = ['/lib', '/usr/lib']
+        candidates += [os.path.join(d, name)
+                       for d in self.ld_so_conf() + default_dirs]
+        found = None
+        for candidate in candidates:
+            if self._compatible(candidate, obj):
+                found = candidate
+                break
+        self.lookup_cache[key] = found
+        return found
+
+    def _default_interp(self, obj):
+        shell = self.load('/bin/sh')
+        if shell and shell.interp and self._compatible(shell.interp, obj):
+            return shell.interp
+        return None
+
+    def _compatible(self, path, obj):
+        lib = self.load(path)
+        return (lib is not None and lib.elf_class == obj.elf_class and
+                lib.machine == obj.machine)
+
+    def _expand(self, value, obj_path, obj):
+        origin = os.path.dirname(os.path.abspath(obj_path))
+        replaces = [
+            ('$ORIGIN', origin), ('${ORIGIN}', origin),
+            ('$LIB', 'lib64' if obj.elf_class == 2 else 'lib'),
+            ('${LIB}', 'lib64' if obj.elf_class == 2 else 'lib'),
+            ('$PLATFORM', os.uname()[4]), ('${PLATFORM}', os.uname()[4]),
+        ]
+        dirs = []
+        for d in value.split(':'):
+            for k, v in replaces:
+                d = d.replace(k, v)
+            dirs.append(d)
+        return dirs
+
+
+class BlockCompressor(object):
+    def __init__(self, fileobj, compression, threads=1):
+        self.fileobj = fileobj
+        self.compress, self.block_size = COMPRESSION_TYPE[compression]
+        self.threads = max(threads, 1)
+        self.buf = []
+        self.buf_len = 0
+        self.pending = collections.deque()
+        self.pool = None
+        if self.compress and self.threads > 1:
+            self.pool = ThreadPool(self.threads)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.blocks = []
+        self.hash = hashlib.sha512()
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        self.hash.update(data)
+        self.buf.append(data)
+        self.buf_len += len(data)
+        if self.buf_len >= self.block_size:
+            data = b''.join(self.buf)
+            self.buf, self.buf_len = [], 0
+            for i in range(0, len(data) - self.block_size + 1,
+                           self.block_size):
+                self._submit(data[i:i + self.block_size])
+            rest = len(data) % self.block_size
+            if rest:
+                self.buf, self.buf_len = [data[-rest:]], rest
+
+    def close(self):
+        try:
+            if self.buf_len:
+                self._submit(b''.join(self.buf))
+                self.buf, self.buf_len = [], 0
+            while self.pending:
+                self._write_block(self.pending.popleft())
+        finally:
+            if self.pool:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+
+    def _submit(self, block):
+        if not self.compress:
+            self._write_block(block)
+        elif self.pool is None:
+            self._write_block(self.compress(block))
+        else:
+            self.pending.append(self.pool.apply_async(self.compress, (block,)))
+            while len(self.pending) > self.threads * 2:
+                self._write_block(self.pending.popleft())
+
+    def _write_block(self, block):
+        if not isinstance(block, bytes):
+            block = block.get()
+        self.blocks.append(self.bytes_out)
+        self.bytes_out += len(block)
+        self.fileobj.write(block)
+
+
+class AciIndex(object):
+    def __init__(self, aci_path):
+        self.path = aci_path + '.index'
+        with open(self.path) as f:
+            index = json.load(f)
+        if index.get('size') != _file_size(aci_path):
+            raise Exception('{0} does not match {1}; rebuild the ACI'
+                            .format(self.path, aci_path))
+        self.compression = index['compression']
+        self.block_size = index['block_size']
+        self.blocks = index['blocks'] + [index['size']]
+        self.names = [x[0] for x in index['members']]
+        self.members = dict((x[0], x[1:]) for x in index['members'])
+        self.file = open(aci_path, 'rb')
+
+    def close(self):
+        self.file.close()
+
+    def read(self, offset, size):
+        if size <= 0:
+            return b''
+        first = offset // self.block_size
+        last = (offset + size - 1) // self.block_size
+        data = []
+        for i in range(first, last + 1):
+            self.file.seek(self.blocks[i])
+            data.append(_decompress_block(self.compression, self.file.read(
+                self.blocks[i + 1] - self.blocks[i])))
+        start = offset - first * self.block_size
+        return b''.join(data)[start:start + size]
+
+    def member(self, name):
+        if name not in self.members:
+            raise KeyError('{0} is not found in {1}'.format(name, self.path))
+        header, data, size = self.members[name]
+        tar = tarfile.open(fileobj=io.BytesIO(
+            self.read(header, data + size - header)), mode='r:')
+        info = tar.next()
+        if info.islnk():
+            tar, target = self.member(info.linkname)
+            target.name = info.name
+            info = target
+        return tar, info
+
+
+class ExcludeMatcher(object):
+    def __init__(self, patterns):
+        self.trie = {}
+        self.globs = []
+        for pattern in patterns:
+            if not re.search(r'[*?\[]', pattern):
+                node = self.trie
+                for c in pattern:
+                    node = node.setdefault(c, {})
+                node[None] = True
+                continue
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            if '/' not in pattern:
+                pattern = '**/' + pattern
+            regex = ''
+            i = 0
+            while i < len(pattern):
+                if pattern.startswith('**/', i):
+                    regex += '(?:.*/)?'
+                    i += 3
+                elif pattern.startswith('**', i):
+                    regex += '.*'
+                    i += 2
+                elif pattern[i] == '*':
+                    regex += '[^/]*'
+                    i += 1
+                elif pattern[i] == '?':
+                    regex += '[^/]'
+                    i += 1
+                elif pattern[i] == '[':
+                    j = i + 1
+                    if pattern[j:j + 1] == '!':
+                        j += 1
+                    if pattern[j:j + 1] == ']':
+                        j += 1
+                    j = pattern.find(']', j)
+                    if j < 0:
+                        regex += re.escape('[')
+                        i += 1
+                        continue
+                    body = pattern[i + 1:j].replace('\\', '\\\\')
+                    if body.startswith('!'):
+                        body = '^' + body[1:]
+                    regex += '[' + body + ']'
+                    i = j + 1
+                else:
+                    regex += re.escape(pattern[i])
+                    i += 1
+            if not regex.startswith('(?:.*/)?') and not pattern.startswith('/'):
+                regex = '(?:.*/)?' + regex
+            self.globs.append((re.compile(regex + '(/.*)?$'), dir_only))
+
+    def __call__(self, path, is_dir=False):
+        node = self.trie
+        for c in path:
+            if None in node:
+                return True
+            node = node.get(c)
+            if node is None:
+                break
+        else:
+            if None in node:
+                return True
+        for regex, dir_only in self.globs:
+            m = regex.match(path)
+            if m and (not dir_only or is_dir or m.group(1) is not None):
+                return True
+        return False
+
+    def __bool__(self):
+        return bool(self.trie or self.globs)
+
+
+def _walk_tree(top):
+    stack = [top]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            entries = sorted(os.scandir(dirpath), key=lambda e: e.name)
+        except OSError:
+            continue
+        dirs = [e for e in entries if e.is_dir()]
+        files = [e for e in entries if not e.is_dir()]
+        yield dirpath, dirs, files
+        stack += [e.path for e in reversed(dirs) if not e.is_symlink()]
+
+
+def _copy_file(src, dst, hardlink=False):
+    if hardlink:
+        try:
+            os.link(os.path.realpath(src), dst)
+            return
+        except OSError:
+            pass
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except (IOError, OSError):
+                _copy_data(fsrc, fdst)
+    shutil.copystat(src, dst)
+
+
+def _copy_data(fsrc, fdst):
+    size = os.fstat(fsrc.fileno()).st_size
+    for name in ('copy_file_range', 'sendfile'):
+        func = getattr(os, name, None)
+        if func is None:
+            continue
+        offset = 0
+        try:
+            while offset < size:
+                if name == 'copy_file_range':
+                    n = func(fsrc.fileno(), fdst.fileno(), size - offset,
+                             offset, offset)
+                else:
+                    n = func(fdst.fileno(), fsrc.fileno(), offset,
+                             size - offset)
+                if n == 0:
+                    break
+                offset += n
+            if offset == size:
+                return
+        except OSError:
+            pass
+        fdst.seek(0)
+        fdst.truncate()
+    fsrc.seek(0)
+    shutil.copyfileobj(fsrc, fdst, 1 << 20)
+
+
+def _scan_tree(root, skip=()):
+    state = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if path in skip:
+                continue
+            st = os.lstat(path)
+            link = os.readlink(path) if os.path.islink(path) else None
+            state[path[len(root):]] = (
+                st.st_mode, st.st_uid, st.st_gid, st.st_size,
+                st.st_mtime, st.st_ctime, st.st_ino, link)
+        dirnames[:] = [x for x in dirnames
+                       if os.path.join(dirpath, x) not in skip]
+    return state
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+def _extract_tar(tar, path):
+    kwargs = {'numeric_owner': True}
+    if hasattr(tarfile, 'fully_trusted_filter'):
+        kwargs['filter'] = 'fully_trusted'
+    tar.extractall(path, **kwargs)
+    for info in tar.getmembers():
+        if info.issym():
+            os.utime(os.path.join(path, info.name),
+                     (info.mtime, info.mtime), follow_symlinks=False)
+
+
+def _hash_path(path, is_exclude=None):
+    h = hashlib.sha256()
+    if os.path.isdir(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            if is_exclude:
+                dirnames[:] = [x for x in dirnames if not is_exclude(
+                    os.path.join(dirpath, x), True)]
+                filenames = [x for x in filenames
+                             if not is_exclude(os.path.join(dirpath, x))]
+            dirnames.sort()
+            for name in sorted(filenames):
+                st = os.lstat(os.path.join(dirpath, name))
+                h.update('{0}\0{1}\0{2}\0{3}\n'.format(
+                    os.path.join(dirpath, name)[len(path):], st.st_mode,
+                    st.st_size, st.st_mtime).encode('utf-8'))
+    elif os.path.isfile(path):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    else:
+        return None
+    return h.hexdigest()
+
+
+def _makedirs(path, mode=0o777):
+    try:
+        os.makedirs(path, mode)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def _resolve_in_root(root, path):
+    parts = [x for x in path.split('/') if x]
+    resolved, hops = [], 0
+    while parts:
+        name = parts.pop(0)
+        if name == '.':
+            continue
+        if name == '..':
+            if resolved:
+                resolved.pop()
+            continue
+        full = os.path.join(root, *(resolved + [name]))
+        if os.path.islink(full) and hops < 40:
+            hops += 1
+            target = os.readlink(full)
+            if target.startswith('/'):
+                resolved = []
+            parts = [x for x in target.split('/') if x] + parts
+            continue
+        resolved.append(name)
+    return '/' + '/'.join(resolved)
+
+
+def _paths_overlap(a, b):
+    if a == '/' or b == '/' or a == b:
+        return True
+    return a.startswith(b + '/') or b.startswith(a + '/')
+
+
+class StepCache(object):
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        _makedirs(cache_dir)
+
+    @staticmethod
+    def key(parent, step, inputs):
+        step = dict((k, v) for k, v in step.items() if k != 'name')
+        return hashlib.sha256(json.dumps([parent, step, inputs],
+                                         sort_keys=True).encode('utf-8')
+                              ).hexdigest()
+
+    def chain(self, key, has_base=None):
+        keys = []
+        while key:
+            meta = self._read_meta(key)
+            if meta is None:
+                return None
+            if meta.get('base') and has_base and not has_base(meta['base']):
+                return None
+            keys.insert(0, key)
+            key = meta['parent']
+        return keys
+
+    def restore(self, key, rootfs, use_base=None, since=None):
+        keys = self.chain(key) or []
+        if since in keys:
+            keys = keys[keys.index(since) + 1:]
+        restored = since
+        for k in keys:
+            entry = os.path.join(self.cache_dir, k)
+            meta = self._read_meta(k)
+            if meta is None:
+                break
+            try:
+                tar = tarfile.open(os.path.join(entry, 'diff.tar'))
+            except (IOError, OSError):
+                break
+            with tar:
+                if meta.get('base'):
+                    use_base(meta['base'])
+                for path in sorted(meta['deleted'], reverse=True):
+                    path = rootfs + path
+                    if os.path.isdir(path) and not os.path.islink(path):
+                        shutil.rmtree(path)
+                    elif os.path.lexists(path):
+                        os.unlink(path)
+                _extract_tar(tar, rootfs)
+            if meta.get('mtime') is not None:
+                os.utime(rootfs, (meta['mtime'], meta['mtime']))
+            try:
+                os.utime(os.path.join(entry, 'meta.json'), None)
+            except OSError:
+                pass
+            restored = k
+        return restored
+
+    def store(self, key, parent, rootfs, before, after, base=None):
+        deleted, changed = [], []
+        if base:
+            before = after
+        for path, st in before.items():
+            if path not in after:
+                deleted.append(path)
+            elif (after[path][0] & 0o170000) != (st[0] & 0o170000):
+                deleted.append(path)
+        for path in sorted(after.keys()):
+            if before.get(path) != after[path]:
+                changed.append(path)
+        tmp = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-')
+        try:
+            with tarfile.open(os.path.join(tmp, 'diff.tar'), 'w',
+                              format=tarfile.GNU_FORMAT) as tar:
+                for path in changed:
+                    info = tar.gettarinfo(rootfs + path, path)
+                    if info is None:
+                        continue
+                    if info.isreg():
+                        with open(rootfs + path, 'rb') as f:
+                            tar.addfile(info, f)
+                    else:
+                        tar.addfile(info)
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump({'parent': parent, 'deleted': sorted(deleted),
+                           'base': base,
+                           'mtime': os.lstat(rootfs).st_mtime}, f)
+            try:
+                os.rename(tmp, os.path.join(self.cache_dir, key))
+            except OSError:
+                shutil.rmtree(tmp)
+        except:
+            shutil.rmtree(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        entries, total = [], 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                size = os.path.getsize(os.path.join(path, 'diff.tar'))
+                atime = os.path.getmtime(os.path.join(path, 'meta.json'))
+            except OSError:
+                continue
+            entries.append((atime, size, path))
+            total += size
+        for atime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def _read_meta(self, key):
+        try:
+            with open(os.path.join(self.cache_dir, key, 'meta.json')) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+
+class DownloadCache(object):
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        for name in ('blobs', 'urls'):
+            _makedirs(os.path.join(cache_dir, name))
+
+    def fetch(self, url, sha256=None, sink=None):
+        if sha256 and os.path.isfile(self.blob_path(sha256)):
+            return self.blob_path(sha256)
+        base = os.path.join(self.cache_dir, 'urls',
+                            hashlib.sha256(url.encode('utf-8')).hexdigest())
+        with open(base + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if sha256 and os.path.isfile(self.blob_path(sha256)):
+                return self.blob_path(sha256)
+            meta = self._read_json(base + '.json')
+            if meta and not os.path.isfile(self.blob_path(meta['sha256'])):
+                meta = None
+            if meta and sha256 == meta['sha256']:
+                return self.blob_path(sha256)
+            return self._download(url, base, meta, sha256, sink)
+
+    def validators(self, url):
+        base = os.path.join(self.cache_dir, 'urls',
+                            hashlib.sha256(url.encode('utf-8')).hexdigest())
+        meta = self._read_json(base + '.json')
+        if meta and not os.path.isfile(self.blob_path(meta['sha256'])):
+            meta = None
+        req = Request(url)
+        if meta and meta.get('etag'):
+            req.add_header('If-None-Match', meta['etag'])
+        if meta and meta.get('last_modified'):
+            req.add_header('If-Modified-Since', meta['last_modified'])
+        try:
+            res = urlopen(req)
+        except HTTPError as e:
+            if e.code == 304 and meta:
+                return meta.get('etag') or meta.get('last_modified')
+            raise
+        with res:
+            header = res.info()
+            return header.get('etag') or header.get('last-modified')
+
+    def blob_path(self, digest):
+        return os.path.join(self.cache_dir, 'blobs', digest)
+
+    def _download(self, url, base, meta, sha256, sink=None):
+        part, part_meta = base + '.part', self._read_json(base + '.part.json')
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        req = Request(url)
+        if offset and part_meta and (part_meta.get('etag') or
+                                     part_meta.get('last_modified')):
+            req.add_header('Range', 'bytes={0}-'.format(offset))
+            req.add_header('If-Range', part_meta.get('etag') or
+                           part_meta['last_modified'])
+        elif meta:
+            offset = 0
+            if meta.get('etag'):
+                req.add_header('If-None-Match', meta['etag'])
+            if meta.get('last_modified'):
+                req.add_header('If-Modified-Since', meta['last_modified'])
+        else:
+            offset = 0
+        try:
+            res = urlopen(req)
+        except HTTPError as e:
+            if e.code == 304 and meta:
+                if sha256 and sha256 != meta['sha256']:
+                    raise Exception('sha256 mismatch: {0} (expected {1}, '
+                                    'got {2})'.format(url, sha256,
+                                                      meta['sha256']))
+                return self.blob_path(meta['sha256'])
+            if e.code == 416 and offset:
+                os.unlink(part)
+                return self._download(url, base, meta, sha256, sink)
+            raise
+        with res:
+            header = res.info()
+            validators = {'etag': header.get('etag'),
+                          'last_modified': header.get('last-modified')}
+            h = hashlib.sha256()
+            if offset and res.getcode() == 206:
+                with open(part, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b''):
+                        h.update(chunk)
+                        if sink:
+                            sink(chunk)
+                mode = 'ab'
+            else:
+                mode = 'wb'
+                with open(base + '.part.json', 'w') as f:
+                    json.dump(validators, f)
+            with open(part, mode) as f:
+                for chunk in iter(lambda: res.read(1 << 20), b''):
+                    h.update(chunk)
+                    f.write(chunk)
+                    if sink:
+                        sink(chunk)
+        digest = h.hexdigest()
+        if sha256 and sha256 != digest:
+            os.unlink(part)
+            raise Exception('sha256 mismatch: {0} (expected {1}, got {2})'
+                            .format(url, sha256, digest))
+        os.rename(part, self.blob_path(digest))
+        os.unlink(base + '.part.json')
+        validators.update({'url': url, 'sha256': digest})
+        with open(base + '.json.tmp', 'w') as f:
+            json.dump(validators, f)
+        os.rename(base + '.json.tmp', base + '.json')
+        return self.blob_path(digest)
+
+    def _read_json(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+
+class BaseCache(object):
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        _makedirs(cache_dir)
+
+    def path(self, digest):
+        return os.path.join(self.cache_dir, digest)
+
+    def exists(self, digest):
+        return os.path.isdir(self.path(digest))
+
+    def staging(self):
+        return tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-')
+
+    def commit(self, staging, digest):
+        try:
+            os.rename(staging, self.path(digest))
+        except OSError:
+            shutil.rmtree(staging)
+
+
+class StreamExtractor(object):
+    MAGICS = [
+        (b'\x1f\x8b', ['-z']),
+        (b'\xfd7zXZ\x00', ['-J']),
+        (b'BZh', ['-j']),
+        (b'\x28\xb5\x2f\xfd', ['--zstd']),
+        (b'\x04\x22\x4d\x18', ['-I', 'lz4']),
+    ]
+
+    def __init__(self, path, max_chunks=16, track=None):
+        self.path = path
+        self.track = track
+        self.head = b''
+        self.proc = None
+        self.thread = None
+        self.error = None
+        self.chunks = queue.Queue(max_chunks)
+
+    @property
+    def started(self):
+        return self.proc is not None or len(self.head) > 0
+
+    def write(self, data):
+        if self.proc is None:
+            self.head += data
+            if len(self.head) < 6:
+                return
+            data, self.head = self.head, b''
+            self._start(data)
+        self.chunks.put(data)
+
+    def close(self):
+        if self.proc is None:
+            if not self.head:
+                return
+            self._start(self.head)
+        self.chunks.put(None)
+        self.thread.join()
+        if self.proc.wait() != 0 or self.error:
+            raise Exception('tar extraction error')
+
+    def abort(self):
+        if self.thread is None:
+            return
+        self.error = self.error or Exception('aborted')
+        self.chunks.put(None)
+        self.thread.join()
+        self.proc.wait()
+
+    def _start(self, head):
+        flags = []
+        for magic, x in self.MAGICS:
+            if head.startswith(magic):
+                flags = x
+        self.proc = subprocess.Popen(['tar', '-x'] + flags +
+                                     ['-f', '-', '-C', self.path],
+                                     stdin=subprocess.PIPE,
+                                     start_new_session=True)
+        if self.track:
+            self.track(self.proc)
+        self.thread = threading.Thread(target=self._feed)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _feed(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            if self.error:
+                continue
+            try:
+                self.proc.stdin.write(chunk)
+            except (IOError, OSError) as e:
+                self.error = e
+        try:
+            self.proc.stdin.close()
+        except (IOError, OSError):
+            pass
+
 
 class Builder(object):
-    def __init__(self):
+    def __init__(self, resolver='elf', jobs=None, threads=None,
+                 cache_dir=DEFAULT_CACHE_DIR, step_cache=True,
+                 cache_size=10 << 30, base_cache='auto', tracer=None,
+                 elf_resolver=None, log=None, compress_slots=None,
+                 parallel_steps=False, reproducible=False, log_tail=20,
+                 step_timeout=None, index=False):
+        if base_cache not in ('auto', 'overlay', 'clone', 'off'):
+            raise ValueError('"{0}" is not supported base cache mode'
+                             .format(base_cache))
+        if resolver not in ('elf', 'ldd'):
+            raise ValueError('"{0}" is not supported resolver type'
+                             .format(resolver))
+        self.resolver = resolver
+        self.elf_resolver = elf_resolver or ElfResolver()
+        self.tracer = tracer or Tracer()
+        self.tracer.sources.append(lambda: {
+            'elf_cache_hits': self.elf_resolver.hits,
+            'elf_cache_misses': self.elf_resolver.misses})
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.threads = threads or multiprocessing.cpu_count()
+        self.download_cache = DownloadCache(os.path.join(cache_dir,
+                                                         'downloads'))
+        self.base_mode = base_cache
+        self.base_cache = None
+        if base_cache != 'off':
+            self.base_cache = BaseCache(os.path.join(cache_dir, 'bases'))
+        self.base_digest = None
+        self.url_digests = {}
+        self.copy_libs = {}
+        self.step_cache = None
+        if step_cache:
+            self.step_cache = StepCache(os.path.join(cache_dir, 'steps'),
+                                        cache_size)
+        self.log = log or sys.stdout
+        self.log_tail = log_tail
+        self.step_timeout = step_timeout
+        self.step_output = threading.local()
+        self.parallel_steps = parallel_steps
+        self.reproducible = reproducible
+        self.index = index
+        self.epoch = int(os.environ.get('SOURCE_DATE_EPOCH', 0))
+        self.digest_dir = os.path.join(cache_dir, 'digests')
+        self.log_dir = os.path.join(cache_dir, 'logs')
+        self.compress_slots = compress_slots or threading.BoundedSemaphore(1)
         self.seq_backup = 0
         self.mounts = set()
+        self.rootfs_mounts = []
         self.reverts = {}
         self.default_manifest = {
             'acKind': 'ImageManifest',
@@ -42,7 +1498,9 @@ class Builder(object):
             ]
         }
 
-    def build_aci(self, json_path, aci_path, compression, debug):
+    def build_aci(self, json_path, aci_path, compression, debug,
+                  layer_after=None, base_aci=None, base_name=None,
+                  step_log_dir=None):
         self.debug = debug
         self.basedir = os.path.abspath(os.path.dirname(json_path))
         if compression not in COMPRESSION_TYPE:
@@ -57,51 +1515,179 @@ class Builder(object):
 
         if not os.path.isabs(aci_path):
             aci_path = os.path.abspath(aci_path)
+        self.step_log_dir = os.path.abspath(step_log_dir or os.path.join(
+            self.log_dir,
+            hashlib.sha256(aci_path.encode('utf-8')).hexdigest()))
         self.workdir = tempfile.mkdtemp()
         self.rootfs = os.path.join(self.workdir, 'rootfs')
         os.mkdir(self.rootfs, 0o755)
 
         step_map = dict([(name[5:], self.__getattribute__(name))
                          for name in dir(self) if name.startswith('step_')])
+        funcs = []
+        for step in steps:
+            func = step.get('step')
+            if func:
+                func = func.replace('.', '')
+            if not func or func not in step_map:
+                raise ValueError('"step" key not found in build step '
+                                 'or unknown step type')
+            funcs.append(step_map[func])
+        ids = {}
+        for idx, step in enumerate(steps):
+            after = step.get('after', [])
+            for dep in [after] if isinstance(after, str) else after:
+                if dep not in ids:
+                    raise ValueError('"after" of step {0} must refer to the '
+                                     'id of an earlier step: {1}'
+                                     .format(idx + 1, dep))
+            if 'id' in step:
+                if step['id'] in ids:
+                    raise ValueError('duplicate step id "{0}"'
+                                     .format(step['id']))
+                ids[step['id']] = idx
+        split = None
+        if layer_after is not None:
+            if layer_after in ids:
+                split = ids[layer_after]
+            elif str(layer_after).isdigit() and \
+                    0 < int(layer_after) <= len(steps):
+                split = int(layer_after) - 1
+            else:
+                raise ValueError('unknown step for the base layer: {0}'
+                                 .format(layer_after))
+            if not base_aci:
+                base_aci = os.path.splitext(aci_path)[0] + '-base.aci'
+            layer = {
+                'aci_path': os.path.abspath(base_aci),
+                'name': base_name or manifest['name'] + '-base',
+                'compression': compression,
+            }
         try:
-            idx = 1
-            for step in steps:
-                func = step.get('step')
-                if func:
-                    func = func.replace('.', '')
-                if not func or func not in step_map:
-                    raise ValueError('"step" key not found in build step '
-                                     'or unknown step type')
-                name = step.get('name', 'step={0}'.format(step['step']))
-                print('{0}: {1}'.format(idx, name))
-                step_map[func](**step)
-                idx += 1
-            print('cleanup')
-            self._cleanup()
-            print('writing manifest')
-            with open(os.path.join(self.workdir, 'manifest'), 'w') as f:
-                json.dump(manifest, f)
-            print('compressing')
-            self._subprocess_call(['tar', '--numeric-owner', '-c{0}f'
-                                   .format(COMPRESSION_TYPE[compression]),
-                                   aci_path, 'manifest', 'rootfs'],
-                                  cwd=self.workdir)
-            print('done')
+            keys, parent, start = [], None, 0
+            if self.step_cache or split is not None:
+                for step in steps:
+                    parent = StepCache.key(parent, step,
+                                           self._step_inputs(step))
+                    keys.append(parent)
+                parent = None
+            if self.step_cache:
+                has_base = self.base_cache.exists if self.base_cache \
+                    else lambda digest: False
+                for i in range(len(keys), 0, -1):
+                    chain = self.step_cache.chain(keys[i - 1], has_base)
+                    if chain and (split is None or i <= split + 1 or
+                                  keys[split] in chain):
+                        start, parent = i, keys[i - 1]
+                        break
+            phases = [start]
+            if split is not None and start > split + 1:
+                phases = [split + 1, start]
+            done = 0
+            for end in phases:
+                if not end:
+                    continue
+                with self.tracer.span('restore', 'cache', steps=end):
+                    restored = self.step_cache.restore(
+                        keys[end - 1], self.rootfs, self._use_base,
+                        since=keys[done - 1] if done else None)
+                if restored != keys[end - 1]:
+                    end = keys.index(restored) + 1 if restored else 0
+                    self._print('build cache was evicted during restore; '
+                                'rebuilding from step {0}'.format(end + 1))
+                    start, parent = end, restored
+                for idx in range(done, end):
+                    self._print('{0}: {1} (cached)'.format(
+                        idx + 1, self._step_name(steps[idx])))
+                    if funcs[idx] == self.step_setup_chroot:
+                        funcs[idx](**steps[idx])
+                if split is not None and done <= split and end == split + 1:
+                    layer.update(self._write_base_layer(
+                        layer, keys[split], steps[:end], manifest))
+                done = end
+                if start == end:
+                    break
+            state = None
+            breaks = () if split is None else (split,)
+            for levels in self._step_groups(steps, ids, start, breaks):
+                if self.step_cache and state is None:
+                    state = self._scan_rootfs()
+                self.base_digest = None
+                for level in levels:
+                    self._run_steps([(idx, funcs[idx], steps[idx])
+                                     for idx in level])
+                idx = max(max(level) for level in levels)
+                if self.step_cache:
+                    with self.tracer.span('store', 'cache', index=idx + 1):
+                        before, state = state, self._scan_rootfs()
+                        self.step_cache.store(keys[idx], parent, self.rootfs,
+                                              self._strip_volatile(before),
+                                              self._strip_volatile(state),
+                                              base=self.base_digest)
+                    parent = keys[idx]
+                if idx == split:
+                    layer.update(self._write_base_layer(
+                        layer, keys[split], steps[:split + 1], manifest))
+                    state = None
+            self._print('cleanup')
+            with self.tracer.span('cleanup', 'build'):
+                self._cleanup()
+            paths = None
+            if split is not None:
+                manifest, paths = self._app_layer(manifest, layer)
+            self._print('compressing')
+            self._pack_aci(aci_path, manifest, compression, paths)
+            self._print('done')
         finally:
-            self._cleanup()
+            self._cleanup(unmount_rootfs=True)
             shutil.rmtree(self.workdir)
 
-    def step_image(self, url=None, path=None, **kwargs):
+    def step_image(self, url=None, path=None, sha256=None, **kwargs):
         if (url and path) or (not url and not path):
             raise ValueError('"image" step required url or path parameter')
-        if url:
-            path = os.path.basename(url)
-            self._fetch_url(url, path)
-        elif path:
-            if not os.path.isfile(path):
-                raise FileNotFoundError('{0} is not found'.format(path))
-        if self._subprocess_call(['tar', 'xf', path, '-C', self.rootfs]) != 0:
-            raise Exception('tar extraction error')
+        if path and not os.path.isfile(path):
+            raise FileNotFoundError('{0} is not found'.format(path))
+        sha256 = sha256 or self.url_digests.get(url)
+        staging = None
+        if self.base_cache and not os.listdir(self.rootfs):
+            if url and sha256 and self.base_cache.exists(sha256):
+                return self._use_base(sha256)
+            staging = self.base_cache.staging()
+        try:
+            target = staging or self.rootfs
+            extracted = False
+            if url:
+                extractor = StreamExtractor(target, track=self._track)
+                try:
+                    path = self.download_cache.fetch(url, sha256,
+                                                     sink=extractor.write)
+                except:
+                    extractor.abort()
+                    raise
+                if extractor.started:
+                    extractor.close()
+                    extracted = True
+            if not staging:
+                if not extracted and self._subprocess_call(
+                        ['tar', 'xf', path, '-C', target]) != 0:
+                    raise Exception('tar extraction error')
+                return
+            if url:
+                digest = os.path.basename(path)
+            else:
+                digest = _hash_path(os.path.abspath(path))
+            if not extracted and not self.base_cache.exists(digest):
+                if self._subprocess_call(['tar', 'xf', path, '-C',
+                                          target]) != 0:
+                    raise Exception('tar extraction error')
+                extracted = True
+            if extracted:
+                self.base_cache.commit(staging, digest)
+            staging = None
+            self._use_base(digest)
+        finally:
+            if staging:
+                shutil.rmtree(staging)
 
     def step_setup_chroot(self, copy_resolvconf=True,
                           copy_hosts=True,
@@ -175,81 +1761,159 @@ class Builder(object):
         if self._subprocess_call(cmd, env=env, shell=True) != 0:
             raise Exception('failed cmd execution')
 
-    def step_copy(self, binaries=[], find_executable=[], files=[], excludes=[], uid=None, gid=None, mode=None, **kwargs):
-        def is_exclude(path):
-            for prefix in excludes:
-                if path.startswith(prefix):
-                    return True
-            return False
-        def is_executable(path):
-            if '.so.' in path or path.endswith('.so'):
-                return True
-            stat = os.stat(path)
-            if (stat.st_mode & 0o111) != 0:
-                return True
-            return False
+    def step_copy(self, binaries=[], find_executable=[], files=[], excludes=[], uid=None, gid=None, mode=None, jobs=None, hardlink=False, preserve_links=False, dedup=None, **kwargs):
+        is_exclude = ExcludeMatcher(excludes)
         if uid or gid:
             if not uid: uid = -1
             if not gid: gid = -1
         if mode:
             mode = int(mode, 8)
-        libs = set()
+        jobs = jobs or self.jobs
+        files = list(files)
         copy_file_len = len(files)
         for path in binaries:
             if isinstance(path, list):
                 files.append(path)
+        libs = self.copy_libs.pop(
+            self._copy_libs_key(binaries, find_executable, excludes), None)
+        if libs is None:
+            libs = self._copy_libs(binaries, find_executable, is_exclude,
+                                   jobs)
+        for path in sorted(libs):
+            files.append([path, path])
+        with self.tracer.span('plan', 'copy') as args:
+            plan = self._plan_copy(files, copy_file_len, is_exclude,
+                                   preserve_links)
+            ops = self._dedup_copy(list(plan.values()), dedup, jobs)
+            args['files'] = len(ops)
+        with self.tracer.span('copy', 'copy', files=len(ops)):
+            self._run_copy(ops, jobs, hardlink, uid, gid, mode)
+
+    def _copy_libs_key(self, binaries, find_executable, excludes):
+        return json.dumps([binaries, find_executable, excludes],
+                          sort_keys=True)
+
+    def _copy_libs(self, binaries, find_executable, is_exclude, jobs):
+        def is_executable(path, entry=None):
+            if '.so.' in path or path.endswith('.so'):
+                return True
+            st = entry.stat() if entry else os.stat(path)
+            if (st.st_mode & 0o111) != 0:
+                return True
+            return False
+        def scan(target):
+            path, is_binary, entry = target
+            if not is_binary and not is_executable(path, entry):
+                return None
+            return self._ldd(path, return_abspath=True)
+        libs = set()
+        targets = []
+        for path in binaries:
+            if isinstance(path, list):
                 path = path[0]
             else:
                 libs.add(path)
-            libs |= self._ldd(path, return_abspath=True)
+            targets.append((path, True, None))
         for path in find_executable:
-            for dirpath, dirnames, filenames in os.walk(path):
-                if is_exclude(dirpath):
-                    continue
-                for name in filenames:
-                    path = os.path.join(dirpath, name)
-                    if is_executable(path):
-                        libs.add(path)
-                        libs |= self._ldd(path, return_abspath=True)
+            if is_exclude(path, True):
+                continue
+            for dirpath, dirs, entries in _walk_tree(path):
+                dirs[:] = [e for e in dirs
+                           if not is_exclude(os.path.join(dirpath, e.name),
+                                             True)]
+                targets += [(os.path.join(dirpath, e.name), False, e)
+                            for e in entries
+                            if not is_exclude(os.path.join(dirpath, e.name))]
+        with self.tracer.span('scan', 'copy', files=len(targets)):
+            scanned = self._parallel_map(scan, targets, jobs)
+        for (path, is_binary, _), deps in zip(targets, scanned):
+            if deps is None:
+                continue
+            if not is_binary:
+                libs.add(path)
+            libs |= deps
         if len(binaries) < len(libs):
             libs |= set(self._get_glibc_dylibs())
-        for path in libs:
-            files.append([path, path])
-        idx = 0
-        for src, dst in files:
-            if not os.path.isabs(src):
-                src = os.path.abspath(os.path.join(self.basedir, src))
-            if is_exclude(src):
+        return libs
+
+    def step_pycompile(self, paths, python='/usr/bin/python3', optimize=[0],
+                       invalidation_mode='timestamp', excludes=[], jobs=None,
+                       **kwargs):
+        if invalidation_mode not in PYCOMPILE_MODES:
+            raise ValueError('"{0}" is not supported invalidation mode'
+                             .format(invalidation_mode))
+        if not isinstance(optimize, list):
+            optimize = [optimize]
+        if isinstance(paths, str):
+            paths = [paths]
+        is_exclude = ExcludeMatcher(excludes)
+        sources = []
+        for path in paths:
+            path = _resolve_in_root(self.rootfs, path)
+            if is_exclude(path, True):
                 continue
-            dst = os.path.abspath(self.rootfs + dst)
-            dstd = os.path.dirname(dst)
-            if not os.path.islink(dstd) and not os.path.exists(dstd):
-                os.makedirs(dstd)
-            if os.path.isdir(src):
-                self._copytree_overwrite(src, dst, exclude_func=is_exclude)
-            else:
-                shutil.copy2(src, dst)
-                if idx < copy_file_len:
-                    if uid and gid:
-                        os.chown(dst, uid, gid)
-                    if mode:
-                        os.chmod(dst, mode)
-            idx += 1
+            for dirpath, dirs, entries in _walk_tree(self.rootfs + path):
+                dirpath = dirpath[len(self.rootfs):]
+                dirs[:] = [e for e in dirs if e.name != '__pycache__' and
+                           not is_exclude(os.path.join(dirpath, e.name),
+                                          True)]
+                sources += [os.path.join(dirpath, e.name) for e in entries
+                            if e.name.endswith('.py') and e.is_file() and
+                            not is_exclude(os.path.join(dirpath, e.name))]
+        if not sources:
+            return
+        jobs = min(jobs or self.jobs, len(sources))
+        output = getattr(self.step_output, 'current', None)
+        def compile(chunk):
+            proc = subprocess.Popen(
+                ['chroot', self.rootfs, python, '-c', PYCOMPILE_SCRIPT,
+                 ','.join(str(x) for x in optimize), invalidation_mode],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, start_new_session=True)
+            if output is not None:
+                output.track(proc)
+            out, err = proc.communicate('\n'.join(chunk).encode('utf-8'))
+            if err and output is not None:
+                output.write(err)
+            if proc.returncode != 0:
+                lines = err.decode('utf-8', 'replace').strip().splitlines()
+                raise Exception('{0} exited with {1}{2}'.format(
+                    python, proc.returncode,
+                    ': ' + lines[-1] if lines else ''))
+            return json.loads(out.decode('utf-8'))
+        def label(chunk):
+            if len(chunk) == 1:
+                return chunk[0]
+            return '{0} and {1} more'.format(chunk[0], len(chunk) - 1)
+        results = self._parallel_map(
+            compile, [sources[i::jobs] for i in range(jobs)], jobs, label)
+        compiled = sum(x['compiled'] for x in results)
+        fresh = sum(x['fresh'] for x in results)
+        failed = sorted(sum((x['failed'] for x in results), []))
+        for line in failed:
+            self._print('  ' + line)
+        self._print('  {0} compiled, {1} up to date, {2} failed'
+                    .format(compiled, fresh, len(failed)))
 
     def step_symlink(self, links=[], **kwargs):
         for target, linkname in links:
             linkname = os.path.abspath(self.rootfs + '/' + linkname)
-            dirname = os.path.dirname(linkname)
-            if not os.path.exists(dirname):
-                os.makedirs(dirname)
-            else:
-                self._unlink_if_exists(linkname)
+            _makedirs(os.path.dirname(linkname))
+            self._unlink_if_exists(linkname)
             os.symlink(target, linkname)
 
     def step_write(self, path, contents, uid=None, gid=None, mode=None, **kwargs):
-        path = os.path.abspath(self.rootfs + '/./' + path)
-        with open(path, 'w') as f:
+        path = self.rootfs + _resolve_in_root(self.rootfs, '/' + path)
+        tmp = os.path.join(os.path.dirname(path),
+                           '.{0}.tmp'.format(os.path.basename(path)))
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                               0o666), 'w') as f:
             f.write(contents)
+        if os.path.isfile(path):
+            st = os.stat(path)
+            os.chmod(tmp, stat.S_IMODE(st.st_mode))
+            os.chown(tmp, st.st_uid, st.st_gid)
+        os.rename(tmp, path)
         if uid or gid:
             if not uid: uid = -1
             if not gid: gid = -1
@@ -275,11 +1939,28 @@ class Builder(object):
         for path in dirs:
             path = os.path.abspath(self.rootfs + '/./' + path)
             if not os.path.exists(path):
-                os.makedirs(path, mode)
+                _makedirs(path, mode)
                 if uid and gid:
                     os.chown(path, uid, gid)
 
-    def step_ldsocache(self, ldconfig="/sbin/ldconfig", host_base=False, paths=[], **kwargs):
+    def step_ldsocache(self, ldconfig="/sbin/ldconfig", host_base=False, paths=[], native=True, **kwargs):
+        if not native:
+            return self._ldsocache_chroot(ldconfig, host_base, paths)
+        if host_base:
+            dirs = _read_ld_so_conf('/etc/ld.so.conf')
+        else:
+            dirs = _read_ld_so_conf('/etc/ld.so.conf', root=self.rootfs)
+        entries = _scan_ld_so_dirs(self.rootfs, dirs + paths +
+                                   _ld_so_system_dirs(self.rootfs),
+                                   self.elf_resolver.load)
+        path = os.path.join(self.rootfs, 'etc/ld.so.cache')
+        _makedirs(os.path.dirname(path))
+        with open(path + '~', 'wb') as f:
+            f.write(_make_ld_so_cache(entries))
+        os.chmod(path + '~', 0o644)
+        os.rename(path + '~', path)
+
+    def _ldsocache_chroot(self, ldconfig, host_base, paths):
         copy_ldconfig = False
         mkdir_sbin = False
         try:
@@ -295,23 +1976,7 @@ class Builder(object):
             if not os.path.exists(os.path.dirname(chrooted_ldsoconf)):
                 os.makedirs(os.path.dirname(chrooted_ldsoconf))
             if host_base:
-                sys_paths = []
-                configs = ['/etc/ld.so.conf']
-                while len(configs) > 0:
-                    config_path = configs[0]
-                    configs = configs[1:]
-                    with open(config_path, 'r') as f:
-                        for line in f:
-                            line = line.strip()
-                            if len(line) == 0 or line[0] == '#':
-                                continue
-                            if line[0] == '/' and os.path.exists(line):
-                                sys_paths.append(line)
-                            if line.startswith('include '):
-                                line = os.path.join(
-                                    os.path.dirname(config_path), line[8:])
-                                configs += glob.glob(line)
-                paths = sys_paths + paths
+                paths = _read_ld_so_conf('/etc/ld.so.conf') + paths
                 if os.path.exists(chrooted_ldsoconf):
                     os.rename(chrooted_ldsoconf, chrooted_ldsoconf_bk)
                 with open(chrooted_ldsoconf, 'w') as f:
@@ -330,33 +1995,200 @@ class Builder(object):
             elif host_base:
                 os.unlink(chrooted_ldsoconf)
             
-    def _fetch_url(self, url, path):
-        if os.path.isfile(path):
+    def _step_name(self, step):
+        return step.get('name', 'step={0}'.format(step['step']))
+
+    def _step_writes(self, step):
+        kind = step['step'].replace('.', '')
+        if kind in BARRIER_STEPS:
+            return None
+        paths = []
+        if kind == 'copy':
+            if step.get('find_executable') or step.get('binaries') or \
+                    step.get('preserve_links'):
+                return None
+            paths += [dst for src, dst in step.get('files', [])]
+        elif kind == 'symlink':
+            for target, linkname in step.get('links', []):
+                paths.append(linkname)
+                paths.append(os.path.join(os.path.dirname('/' + linkname),
+                                          target))
+        elif kind == 'write':
+            paths.append(step['path'])
+        elif kind in ('mkdir', 'delete'):
+            paths = step.get('dirs' if kind == 'mkdir' else 'files', [])
+            if isinstance(paths, str):
+                paths = [paths]
+        else:
+            return None
+        writes = set()
+        for path in paths:
+            path = _resolve_in_root(self.rootfs, os.path.normpath('/' + path))
+            writes.add(path)
+            parent = os.path.dirname(path)
+            while parent != '/' and not os.path.lexists(self.rootfs + parent):
+                writes.add(parent)
+                parent = os.path.dirname(parent)
+        return writes
+
+    def _step_groups(self, steps, ids, start, breaks=()):
+        idx = start
+        while idx < len(steps):
+            if not self.parallel_steps:
+                yield [[idx]]
+                idx += 1
+                continue
+            writes = self._step_writes(steps[idx])
+            if writes is None or idx in breaks:
+                yield [[idx]]
+                idx += 1
+                continue
+            group = {idx: writes}
+            idx += 1
+            while idx < len(steps) and idx - 1 not in breaks:
+                writes = self._step_writes(steps[idx])
+                if writes is None:
+                    break
+                group[idx] = writes
+                idx += 1
+            depth = {}
+            for i in sorted(group):
+                after = steps[i].get('after', [])
+                deps = set(ids[x] for x in
+                           ([after] if isinstance(after, str) else after))
+                deps |= set(j for j in group if j < i and any(
+                    _paths_overlap(a, b) for a in group[i] for b in group[j]))
+                depth[i] = max([depth[j] + 1 for j in deps if j in depth] +
+                               [0])
+            levels = [[] for _ in range(max(depth.values()) + 1)]
+            for i in sorted(group):
+                levels[depth[i]].append(i)
+            yield levels
+
+    def _run_steps(self, level):
+        def run(item):
+            idx, func, step = item
+            name = self._step_name(step)
+            self._print('{0}: {1}'.format(idx + 1, name))
+            output = StepOutput(
+                os.path.join(self.step_log_dir, '{0:02d}-{1}.log'
+                             .format(idx + 1, step['step'])),
+                self.log_tail, self.log if self.debug else None,
+                step.get('timeout', self.step_timeout))
+            self.step_output.current = output
+            timer = None
+            if output.timeout:
+                timer = threading.Timer(output.timeout, output.expire)
+                timer.daemon = True
+                timer.start()
+            error = None
             try:
-                req = Request(url, method='HEAD') # py3 only
-            except:
-                req = Request(url)
-                req.get_method = lambda : 'HEAD'
-            header = urlopen(req).info()
-            stat = os.stat(path)
-            changed = False
-            if 'content-length' in header:
-                changed |= (stat.st_size != int(header['content-length']))
-            if 'last-modified' in header:
-                remote_gm_time = time.mktime(
-                    email.utils.parsedate(header['last-modified']))
-                local_gm_time = stat.st_mtime + time.timezone
-                changed |= (local_gm_time < remote_gm_time)
-            if not changed:
+                with self.tracer.span(name, 'step', index=idx + 1,
+                                      step=step['step']):
+                    func(**step)
+            except Exception as e:
+                error = e
+            finally:
+                if timer:
+                    timer.cancel()
+                output.close()
+                self.step_output.current = None
+            if output.expired:
+                error = Exception('{0}: timed out after {1} seconds'
+                                  .format(name, output.timeout))
+            if error is None:
                 return
-            os.unlink(path)
-        res = urlopen(Request(url))
-        with open(path, 'wb') as f:
-            shutil.copyfileobj(res, f)
+            lines = output.tail()
+            if lines and not self.debug:
+                self._print('{0}: last {1} lines of output (log: {2})'
+                            .format(idx + 1, len(lines), output.path))
+                for line in lines:
+                    self._print('  ' + line)
+            raise error
+        if len(level) == 1:
+            return run(level[0])
+        def call(item):
+            try:
+                run(item)
+            except Exception as e:
+                return e
+        pool = ThreadPool(len(level))
+        try:
+            errors = [e for e in pool.map(call, level) if e]
+        finally:
+            pool.close()
+            pool.join()
+        if errors:
+            raise errors[0]
+
+    def _step_inputs(self, step):
+        paths = []
+        if step.get('step') == 'image' and step.get('path'):
+            paths.append(step['path'])
+        elif step.get('step') == 'ansible':
+            paths.append(step['playbook'])
+        elif step.get('step') == 'copy':
+            for path in step.get('binaries', []):
+                paths.append(path[0] if isinstance(path, list) else path)
+            paths += [src for src, dst in step.get('files', [])]
+        is_exclude = None
+        if step.get('step') == 'copy':
+            is_exclude = ExcludeMatcher(step.get('excludes', []))
+        inputs = []
+        for path in paths:
+            if step['step'] == 'copy':
+                path = os.path.join(self.basedir, path)
+            inputs.append([path, _hash_path(os.path.abspath(path),
+                                            is_exclude)])
+        if step.get('step') == 'copy' and (step.get('binaries') or
+                                           step.get('find_executable')):
+            key = self._copy_libs_key(step.get('binaries', []),
+                                      step.get('find_executable', []),
+                                      step.get('excludes', []))
+            libs = self._copy_libs(step.get('binaries', []),
+                                   step.get('find_executable', []),
+                                   is_exclude, step.get('jobs') or self.jobs)
+            self.copy_libs[key] = libs
+            for path in sorted(libs):
+                st = os.stat(path)
+                inputs.append([path, st.st_size, st.st_mtime])
+        url = step.get('url')
+        if step.get('step') == 'image' and url and not step.get('sha256'):
+            validator = self.download_cache.validators(url)
+            if validator is None:
+                if url not in self.url_digests:
+                    self.url_digests[url] = os.path.basename(
+                        self.download_cache.fetch(url))
+                validator = self.url_digests[url]
+            inputs.append([url, validator])
+        return inputs
+
+    def _scan_rootfs(self):
+        return _scan_tree(self.rootfs, self.mounts)
+
+    def _strip_volatile(self, state):
+        volatile = set(self.mounts)
+        for path, backup_path in self.reverts.items():
+            volatile.add(path)
+            volatile.add(backup_path)
+        prefixes = tuple(x[len(self.rootfs):] for x in volatile
+                         if x and x.startswith(self.rootfs + '/'))
+        if not prefixes:
+            return state
+        return dict((path, st) for path, st in state.items()
+                    if not path.startswith(prefixes) or
+                    not any(path == x or path.startswith(x + '/')
+                            for x in prefixes))
 
     def _ldd(self, path, return_abspath = False):
+        if self.resolver == 'elf':
+            libs = self.elf_resolver.resolve(path)
+            if not return_abspath:
+                libs = set([os.path.basename(x) for x in libs])
+            return libs
         libs = set()
         try:
+            self.tracer.count('ldd_calls')
             result = subprocess.check_output(['ldd', path],
                                              stderr=subprocess.STDOUT)
             result = result.decode('ascii').splitlines()
@@ -391,17 +2223,40 @@ class Builder(object):
                     return True
             return False
         libs = []
-        cached = subprocess.check_output(['/sbin/ldconfig', '-p'])
-        for lib in cached.decode('ascii').splitlines():
-            lib = lib.strip()
-            if '/lib32/' in lib or not '=>' in lib: continue
-            if not is_target(lib): continue
-            lib = lib[lib.index('=>')+2:].strip()
+        for _, name, lib in _load_ld_so_cache():
+            if '/lib32/' in lib: continue
+            if not is_target(name): continue
             if not os.path.exists(lib): continue
             libs.append(lib)
         return libs
 
-    def _cleanup(self):
+    def _use_base(self, digest):
+        tree = self.base_cache.path(digest)
+        if not os.path.isdir(tree):
+            raise FileNotFoundError('base image {0} is not cached'
+                                    .format(digest))
+        if self.base_mode in ('auto', 'overlay'):
+            upper = os.path.join(self.workdir, 'upper')
+            work = os.path.join(self.workdir, 'overlay-work')
+            for d in (upper, work):
+                if not os.path.exists(d):
+                    os.mkdir(d, 0o755)
+            shutil.copystat(tree, upper)
+            if self._subprocess_call(
+                    ['mount', '-t', 'overlay', 'overlay', '-o',
+                     'lowerdir={0},upperdir={1},workdir={2}'
+                     .format(tree, upper, work), self.rootfs]) == 0:
+                self.rootfs_mounts.append(self.rootfs)
+                self.base_digest = digest
+                return
+            if self.base_mode == 'overlay':
+                raise Exception('overlayfs mount failed')
+        if self._subprocess_call(['cp', '-a', '--reflink=auto',
+                                  tree + '/.', self.rootfs]) != 0:
+            raise Exception('base image clone failed')
+        self.base_digest = digest
+
+    def _cleanup(self, unmount_rootfs=False):
         mounts = set(self.mounts)
         for path in mounts:
             try:
@@ -416,6 +2271,12 @@ class Builder(object):
             if backup_path:
                 os.rename(backup_path, path)
             del self.reverts[path]
+        while unmount_rootfs and self.rootfs_mounts:
+            path = self.rootfs_mounts.pop()
+            try:
+                subprocess.check_output(['umount', path], stderr=subprocess.STDOUT)
+            except:
+                subprocess.check_output(['umount', '-l', path], stderr=subprocess.STDOUT)
 
     def _merge_manifest(self, manifest):
         if MAGIC_KEY in manifest:
@@ -448,7 +2309,7 @@ class Builder(object):
         self.reverts[path] = None
 
     def _unlink_if_exists(self, path):
-        if path and os.path.isfile(path):
+        if path and (os.path.islink(path) or os.path.isfile(path)):
             os.unlink(path)
 
     def _backup_suffix(self):
@@ -456,45 +2317,791 @@ class Builder(object):
         self.seq_backup += 1
         return '.bk-{0}'.format(seq)
 
-    def _copytree_overwrite(self, src, dst, exclude_func=None):
+    def _copytree_overwrite(self, src, dst, exclude_func=None, jobs=None,
+                            hardlink=False, preserve_links=False, dedup=None):
         if os.path.isfile(src):
             self._unlink_if_exists(dst)
-            shutil.copy2(src, dst)
+            _copy_file(src, dst, hardlink)
             return
-        if not os.path.exists(dst):
-            os.makedirs(dst)
-        for dirpath, dirnames, filenames in os.walk(src):
-            if exclude_func and exclude_func(dirpath):
+        jobs = jobs or self.jobs
+        ops = [(kind, s, d, False) for kind, s, d in
+               self._plan_copytree(src, dst, exclude_func, preserve_links)]
+        self._run_copy(self._dedup_copy(ops, dedup, jobs), jobs, hardlink)
+
+    def _run_copy(self, ops, jobs, hardlink=False, uid=None, gid=None,
+                  mode=None):
+        def copy(op):
+            kind, src, dst, set_attrs = op
+            link = hardlink and not (set_attrs and (uid or gid or mode))
+            if kind != 'copy':
+                if os.path.islink(dst) or os.path.isfile(dst):
+                    os.unlink(dst)
+                if kind == 'symlink':
+                    os.symlink(src, dst)
+                else:
+                    os.link(src, dst)
+                return
+            self._unlink_if_exists(dst)
+            _copy_file(src, dst, hardlink=link)
+            if set_attrs:
+                if uid and gid:
+                    os.chown(dst, uid, gid)
+                if mode:
+                    os.chmod(dst, mode)
+            self._count_copy(dst)
+        self._parallel_map(copy, [op for op in ops if op[0] == 'copy'], jobs,
+                           lambda op: op[1])
+        self._parallel_map(copy, [op for op in ops if op[0] != 'copy'], jobs,
+                           lambda op: op[2])
+
+    def _dedup_copy(self, ops, dedup, jobs):
+        if not dedup:
+            return ops
+        if dedup not in ('inode', 'content'):
+            raise ValueError('"{0}" is not supported dedup mode'
+                             .format(dedup))
+        keys, sizes = {}, collections.defaultdict(list)
+        for op in ops:
+            if op[0] != 'copy':
                 continue
+            st = os.stat(op[1])
+            keys[op[2]] = (op[3], st.st_dev, st.st_ino)
+            sizes[(op[3], st.st_size, st.st_mode, st.st_uid,
+                   st.st_gid)].append(op)
+        if dedup == 'content':
+            candidates = [(key, op) for key, group in sizes.items()
+                          if len(group) > 1 for op in group]
+            digests = self._parallel_map(lambda x: _hash_path(x[1][1]),
+                                         candidates, jobs, lambda x: x[1][1])
+            for (key, op), digest in zip(candidates, digests):
+                keys[op[2]] = key + (digest,)
+        firsts, result = {}, []
+        for op in ops:
+            if op[0] == 'copy':
+                first = firsts.setdefault(keys[op[2]], op[2])
+                if first != op[2]:
+                    op = ('link', first) + op[2:]
+            result.append(op)
+        return result
+
+    def _count_copy(self, path):
+        if self.tracer.enabled:
+            self.tracer.count('files_copied')
+            self.tracer.count('bytes_copied', os.lstat(path).st_size)
+
+    def _plan_copy(self, files, copy_file_len, is_exclude,
+                   preserve_links=False):
+        plan = collections.OrderedDict()
+        idx = 0
+        for src, dst in files:
+            if not os.path.isabs(src):
+                src = os.path.abspath(os.path.join(self.basedir, src))
+            if is_exclude(src):
+                idx += 1
+                continue
+            is_dir = stat.S_ISDIR(os.stat(src).st_mode)
+            if is_dir and is_exclude(src, True):
+                idx += 1
+                continue
+            dst = os.path.abspath(self.rootfs + dst)
+            dstd = os.path.dirname(dst)
+            if not os.path.lexists(dstd):
+                _makedirs(dstd)
+            ops = []
+            if is_dir:
+                ops = [(kind, s, d, False) for kind, s, d in
+                       self._plan_copytree(src, dst, is_exclude,
+                                           preserve_links)]
+            while not is_dir and preserve_links and os.path.islink(src) and \
+                    dst == os.path.abspath(self.rootfs + src):
+                target = os.readlink(src)
+                hop = os.path.normpath(os.path.join(os.path.dirname(src),
+                                                    target))
+                if not os.path.isfile(hop) or is_exclude(hop):
+                    break
+                ops.append(('symlink', target, dst, False))
+                src, dst = hop, os.path.abspath(self.rootfs + hop)
+                _makedirs(os.path.dirname(dst))
+            if not is_dir:
+                ops.append(('copy', src, dst, idx < copy_file_len))
+            for op in ops:
+                plan.pop(op[2], None)
+                plan[op[2]] = op
+            idx += 1
+        return plan
+
+    def _plan_copytree(self, src, dst, exclude_func=None,
+                       preserve_links=False):
+        ops = []
+        _makedirs(dst)
+        for dirpath, dirs, entries in _walk_tree(src):
+            if exclude_func:
+                dirs[:] = [e for e in dirs if not exclude_func(
+                    os.path.join(dirpath, e.name), True)]
             dirpath2 = os.path.abspath(dst + '/' + dirpath[len(src):])
             if not os.path.exists(dirpath2):
                 os.mkdir(dirpath2)
                 shutil.copystat(dirpath, dirpath2)
-            for name in filenames:
-                if exclude_func:
-                    path = os.path.join(dirpath, name)
-                    if exclude_func(path):
+            links = [e for e in dirs if e.is_symlink()] if preserve_links \
+                else []
+            for entry in sorted(entries + links, key=lambda e: e.name):
+                path = os.path.join(dirpath, entry.name)
+                if exclude_func and exclude_func(path):
+                    continue
+                dst_path = os.path.join(dirpath2, entry.name)
+                if preserve_links and entry.is_symlink():
+                    target = os.readlink(path)
+                    hop = os.path.normpath(os.path.join(dirpath, target))
+                    if not os.path.isabs(target) and \
+                            hop.startswith(src.rstrip('/') + '/'):
+                        ops.append(('symlink', target, dst_path))
+                        continue
+                    if entry in links:
                         continue
-                path = os.path.join(dirpath2, name)
-                self._unlink_if_exists(path)
-                shutil.copy2(os.path.join(dirpath, name), path)
+                ops.append(('copy', path, dst_path))
+        return ops
+
+    def _parallel_map(self, func, items, jobs, name=None):
+        def call(item):
+            try:
+                return func(item), None
+            except Exception as e:
+                return None, e
+        if jobs > 1 and len(items) > 1:
+            pool = ThreadPool(min(jobs, len(items)))
+            try:
+                results = pool.map(call, items)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [call(item) for item in items]
+        errors = [(item, e) for item, (_, e) in zip(items, results) if e]
+        for item, e in errors:
+            if name:
+                item = name(item)
+            elif isinstance(item, tuple):
+                item = item[0]
+            self._print('  {0}: {1}'.format(item, e))
+        if errors:
+            raise Exception('{0} of {1} files failed'
+                            .format(len(errors), len(items)))
+        return [result for result, _ in results]
+
+    def _write_aci(self, aci_path, manifest, compression, paths=None,
+                   members=None):
+        def record(info, offset):
+            if info is not None and members is not None:
+                size = info.size if info.isreg() else 0
+                members.append([info.name, offset,
+                                tar.offset - size - (-size % 512), size])
+        with open(aci_path, 'wb') as f:
+            compressor = BlockCompressor(f, compression, self.threads)
+            try:
+                tar = tarfile.open(fileobj=compressor, mode='w|',
+                                   format=tarfile.GNU_FORMAT)
+                data = json.dumps(manifest).encode('utf-8')
+                info = tarfile.TarInfo('manifest')
+                info.size = len(data)
+                info.mtime = self.epoch if self.reproducible \
+                    else int(time.time())
+                info.mode = 0o644
+                tar.addfile(info, io.BytesIO(data))
+                record(info, 0)
+                for path, arcname in self._tar_entries(paths):
+                    offset = tar.offset
+                    record(self._add_entry(tar, path, arcname), offset)
+                tar.close()
+            finally:
+                compressor.close()
+        return compressor
+
+    def _tar_entries(self, paths=None):
+        if paths is not None:
+            yield self.rootfs, 'rootfs'
+            for path in paths:
+                yield self.rootfs + path, 'rootfs' + path
+            return
+        stack = [(self.rootfs, 'rootfs')]
+        while stack:
+            path, arcname = stack.pop()
+            yield path, arcname
+            if os.path.isdir(path) and not os.path.islink(path):
+                for name in sorted(os.listdir(path), reverse=True):
+                    stack.append((os.path.join(path, name),
+                                  arcname + '/' + name))
+
+    def _tar_owner(self, uid, gid):
+        if self.reproducible and os.geteuid() != 0:
+            if uid == os.geteuid():
+                uid = 0
+            if gid == os.getegid():
+                gid = 0
+        return uid, gid
+
+    def _add_entry(self, tar, path, arcname):
+        info = tar.gettarinfo(path, arcname)
+        if info is None:
+            return None
+        info.uname = info.gname = ''
+        info.uid, info.gid = self._tar_owner(info.uid, info.gid)
+        if self.reproducible:
+            info.mtime = self.epoch
+        if info.isreg():
+            with open(path, 'rb') as f:
+                tar.addfile(info, f)
+        else:
+            tar.addfile(info)
+        return info
+
+    def _pack_aci(self, aci_path, manifest, compression, paths=None,
+                  extra=None):
+        meta_path = aci_path + '.json'
+        try:
+            with open(meta_path) as f:
+                old = json.load(f)
+        except (IOError, OSError, ValueError):
+            old = {}
+        with self.tracer.span('digest', 'build') as args:
+            digest = self._rootfs_digest(aci_path, paths)
+            args['digest'] = digest
+        meta = {
+            'digest': digest,
+            'manifest': hashlib.sha256(json.dumps(
+                manifest, sort_keys=True).encode('utf-8')).hexdigest(),
+            'compression': compression,
+            'reproducible': self.reproducible,
+        }
+        if all(old.get(k) == v for k, v in meta.items()) and \
+                old.get('size') == _file_size(aci_path) and \
+                (not self.index or os.path.exists(aci_path + '.index')):
+            self._print('{0} is up to date'.format(aci_path))
+            meta = old
+        else:
+            meta.update(self._compress_aci(aci_path, manifest, compression,
+                                           paths))
+        meta.update(extra or {})
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f, indent=2, sort_keys=True)
+        os.rename(meta_path + '.tmp', meta_path)
+        return meta
+
+    def _compress_aci(self, aci_path, manifest, compression, paths):
+        index_path = aci_path + '.index'
+        if os.path.exists(index_path):
+            os.unlink(index_path)
+        members = [] if self.index else None
+        with self.compress_slots, self.tracer.span(
+                'compress', 'build', compression=compression) as args:
+            compressor = self._write_aci(aci_path, manifest, compression,
+                                         paths, members)
+            args.update({'bytes_in': compressor.bytes_in,
+                         'bytes_out': compressor.bytes_out,
+                         'threads': self.threads})
+        meta = {'imageID': 'sha512-' + compressor.hash.hexdigest(),
+                'size': _file_size(aci_path)}
+        if self.index:
+            with open(index_path + '.tmp', 'w') as f:
+                json.dump({
+                    'compression': compression,
+                    'block_size': compressor.block_size,
+                    'blocks': compressor.blocks,
+                    'size': meta['size'],
+                    'members': members,
+                }, f, separators=(',', ':'))
+            os.rename(index_path + '.tmp', index_path)
+        return meta
+
+    def _rootfs_digest(self, aci_path, paths=None):
+        cache_path = os.path.join(self.digest_dir, hashlib.sha256(
+            aci_path.encode('utf-8')).hexdigest() + '.json')
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+        except (IOError, OSError, ValueError):
+            cached = {}
+        entries, hashes, misses, inodes = [], {}, [], {}
+        for path, arcname in self._tar_entries(paths):
+            st = os.lstat(path)
+            uid, gid = self._tar_owner(st.st_uid, st.st_gid)
+            leaf = [st.st_mode, uid, gid,
+                    self.epoch if self.reproducible else int(st.st_mtime)]
+            if stat.S_ISREG(st.st_mode):
+                inode = (st.st_dev, st.st_ino)
+                if st.st_nlink > 1 and inode in inodes:
+                    leaf.append(['link', inodes[inode]])
+                else:
+                    inodes[inode] = arcname
+                    key = [st.st_dev, st.st_ino, st.st_size, st.st_mtime]
+                    hit = cached.get(arcname)
+                    if hit and hit[:4] == key:
+                        hashes[arcname] = hit
+                    else:
+                        misses.append((path, arcname, key))
+            elif stat.S_ISLNK(st.st_mode):
+                leaf.append(os.readlink(path))
+            elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+                leaf.append(st.st_rdev)
+            entries.append((arcname, leaf))
+        digests = self._parallel_map(lambda x: _hash_path(x[0]), misses,
+                                     self.jobs)
+        for (path, arcname, key), digest in zip(misses, digests):
+            hashes[arcname] = key + [digest]
+        nodes, children = {}, collections.defaultdict(list)
+        for arcname, leaf in entries:
+            if arcname in hashes:
+                leaf.append(hashes[arcname][4])
+            nodes[arcname] = leaf
+            if arcname != 'rootfs':
+                children[os.path.dirname(arcname)].append(arcname)
+        digests = {}
+        for arcname in sorted(nodes, key=lambda x: -x.count('/')):
+            h = hashlib.sha256(json.dumps(nodes[arcname]).encode('utf-8'))
+            for child in children.get(arcname, []):
+                h.update(child.encode('utf-8') + b'\0' +
+                         digests.pop(child).encode('utf-8'))
+            digests[arcname] = h.hexdigest()
+        _makedirs(self.digest_dir)
+        with open(cache_path + '.tmp', 'w') as f:
+            json.dump(hashes, f)
+        os.rename(cache_path + '.tmp', cache_path)
+        return digests['rootfs']
+
+    def _write_base_layer(self, layer, key, steps, manifest):
+        self._cleanup()
+        state = self._strip_volatile(self._scan_rootfs())
+        meta_path = layer['aci_path'] + '.json'
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            meta = {}
+        labels = list(manifest.get('labels', []))
+        if meta.get('key') == key and meta.get('name') == layer['name'] and \
+                meta.get('size') == _file_size(layer['aci_path']):
+            self._print('base layer (unchanged)')
+        else:
+            self._print('base layer')
+            base_manifest = {
+                'acKind': manifest['acKind'],
+                'acVersion': manifest['acVersion'],
+                'name': layer['name'],
+                'labels': labels,
+            }
+            meta = self._pack_aci(layer['aci_path'], base_manifest,
+                                  layer['compression'],
+                                  extra={'key': key, 'name': layer['name']})
+        for step in steps:
+            if step['step'] == 'setup_chroot':
+                self.step_setup_chroot(**step)
+        return {'state': state, 'imageID': meta['imageID'], 'labels': labels}
+
+    def _app_layer(self, manifest, layer):
+        before = layer['state']
+        after = self._scan_rootfs()
+        changed = set()
+        for path, st in after.items():
+            old = before.get(path)
+            if old is None or old[:5] + old[6:] != st[:5] + st[6:]:
+                while path and path not in changed:
+                    changed.add(path)
+                    path = os.path.dirname(path)
+        changed.discard('/')
+        manifest = dict(manifest)
+        manifest['dependencies'] = [{
+            'imageName': layer['name'],
+            'imageID': layer['imageID'],
+            'labels': layer['labels'],
+        }] + manifest.get('dependencies', [])
+        if any(path not in after for path in before):
+            manifest['pathWhitelist'] = sorted(after)
+        return manifest, sorted(changed)
+
+    def _print(self, msg):
+        self.log.write(msg + '\n')
+        self.log.flush()
 
     def _subprocess_call(self, args, **kwargs):
-        if self.debug:
-            return subprocess.call(args, **kwargs)
+        output = getattr(self.step_output, 'current', None)
+        if output is None:
+            output = StepOutput(tail=self.log_tail,
+                                echo=self.log if self.debug else None)
         try:
-            subprocess.check_output(args, stderr=subprocess.STDOUT, **kwargs)
-            return 0
-        except:
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT,
+                                    start_new_session=True, **kwargs)
+        except OSError as e:
+            output.write('{0}\n'.format(e).encode('utf-8'))
             return 1
+        output.track(proc)
+        try:
+            fd = proc.stdout.fileno()
+            while True:
+                data = os.read(fd, 65536)
+                if not data:
+                    break
+                output.write(data)
+        except BaseException:
+            _kill_group(proc)
+            raise
+        finally:
+            proc.stdout.close()
+            ret = proc.wait()
+        return ret
 
-def main():
-    parser = argparse.ArgumentParser(description='App container image builder')
+    def _track(self, proc):
+        output = getattr(self.step_output, 'current', None)
+        if output is not None:
+            output.track(proc)
+
+def _add_build_arguments(parser):
     parser.add_argument('--compression', '-C', action='store', default='gzip',
-                        choices=('gzip', 'xz', 'none', 'bzip2'),
+                        choices=('gzip', 'xz', 'none', 'bzip2', 'zstd', 'lz4'),
                         help='use compression algorithm (default: gzip)')
+    parser.add_argument('--threads', '-T', action='store', type=int,
+                        default=None,
+                        help='number of compression threads '
+                        '(default: number of CPUs)')
     parser.add_argument('--debug', action='store_true',
                         help='enable debug mode')
+    parser.add_argument('--cache-dir', action='store',
+                        default=DEFAULT_CACHE_DIR,
+                        help='build cache directory '
+                        '(default: ~/.cache/aci-packer)')
+    parser.add_argument('--cache-size', action='store', type=int,
+                        default=10240,
+                        help='maximum size of the build step cache in MiB '
+                        '(default: 10240)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use the build step cache')
+    parser.add_argument('--base-cache', action='store', default='auto',
+                        choices=('auto', 'overlay', 'clone', 'off'),
+                        help='how to start from a cached extracted base '
+                        'image (default: auto)')
+    parser.add_argument('--resolver', action='store', default='elf',
+                        choices=('elf', 'ldd'),
+                        help='shared library dependency resolver '
+                        '(default: elf)')
+    parser.add_argument('--parallel-steps', action='store_true',
+                        help='run build steps that touch separate paths '
+                        'at the same time')
+    parser.add_argument('--reproducible', action='store_true',
+                        help='pack with normalized timestamps and owners so '
+                        'that the same rootfs gives the same ACI')
+    parser.add_argument('--layer-after', action='store', default=None,
+                        metavar='STEP',
+                        help='write the rootfs after STEP (step id or '
+                        '1-based index) as a base layer ACI and only the '
+                        'later changes to the output ACI')
+    parser.add_argument('--step-timeout', action='store', type=float,
+                        default=None, metavar='SEC',
+                        help='kill the commands of a step that runs longer '
+                        'than SEC seconds (default: no timeout)')
+    parser.add_argument('--log-tail', action='store', type=int, default=20,
+                        metavar='N',
+                        help='number of output lines shown when a step '
+                        'fails (default: 20)')
+    parser.add_argument('--index', action='store_true',
+                        help='write <aci_path>.index mapping archive members '
+                        'to compressed blocks for inspect/extract')
+
+
+def _builder_kwargs(args):
+    return dict(resolver=args.resolver, jobs=args.copy_jobs,
+                threads=args.threads, cache_dir=args.cache_dir,
+                step_cache=not args.no_cache,
+                cache_size=args.cache_size << 20,
+                base_cache=args.base_cache,
+                parallel_steps=args.parallel_steps,
+                reproducible=args.reproducible,
+                step_timeout=args.step_timeout, log_tail=args.log_tail,
+                index=args.index)
+
+
+def _find_jobs(specs, output_dir):
+    jobs = []
+    for spec in specs:
+        if os.path.isdir(spec):
+            paths = sorted(glob.glob(os.path.join(spec, '*.json')))
+            jobs += [(path, None) for path in paths]
+        elif '=' in spec:
+            jobs.append(tuple(spec.split('=', 1)))
+        else:
+            jobs.append((spec, None))
+    result, names = [], set()
+    for json_path, aci_path in jobs:
+        if not os.path.isfile(json_path):
+            raise FileNotFoundError('{0} is not found\n'.format(json_path))
+        name = os.path.splitext(os.path.basename(json_path))[0]
+        if name in names:
+            raise ValueError('duplicate job name "{0}"'.format(name))
+        names.add(name)
+        if not aci_path:
+            aci_path = os.path.join(output_dir, name + '.aci')
+        result.append((name, json_path, aci_path))
+    return result
+
+
+def build_many(argv):
+    parser = argparse.ArgumentParser(
+        prog='acipacker.py build-many',
+        description='Build many app container images concurrently')
+    _add_build_arguments(parser)
+    parser.add_argument('--jobs', '-j', action='store', type=int,
+                        default=None,
+                        help='number of builds run at the same time '
+                        '(default: number of CPUs)')
+    parser.add_argument('--copy-jobs', action='store', type=int,
+                        default=None,
+                        help='number of parallel workers used by copy steps '
+                        'in each build (default: number of CPUs)')
+    parser.add_argument('--compress-jobs', action='store', type=int,
+                        default=1,
+                        help='number of builds allowed to compress at the '
+                        'same time (default: 1)')
+    parser.add_argument('--output-dir', '-o', action='store', default='.',
+                        help='output directory for manifests given without '
+                        'an output path (default: .)')
+    parser.add_argument('--log-dir', action='store', default=None,
+                        help='directory of per-build logs and status.json '
+                        '(default: same as --output-dir)')
+    parser.add_argument('specs', action='store', nargs='+',
+                        metavar='MANIFEST[=ACI]|DIR',
+                        help='manifest(json) path with an optional output '
+                        'aci path, or a directory of manifests')
+    args = parser.parse_args(argv)
+    log_dir = args.log_dir or args.output_dir
+    for path in (args.output_dir, log_dir):
+        _makedirs(path)
+    jobs = _find_jobs(args.specs, args.output_dir)
+    kwargs = _builder_kwargs(args)
+    kwargs.update(elf_resolver=ElfResolver(),
+                  compress_slots=threading.BoundedSemaphore(
+                      max(1, args.compress_jobs)))
+    lock = threading.Lock()
+
+    def run(job):
+        name, json_path, aci_path = job
+        log_path = os.path.join(log_dir, name + '.log')
+        start = time.time()
+        with open(log_path, 'w') as log:
+            try:
+                builder = Builder(log=log, **kwargs)
+                builder.build_aci(json_path, aci_path, args.compression,
+                                  args.debug, layer_after=args.layer_after,
+                                  step_log_dir=os.path.join(log_dir, name))
+                status = 0
+            except Exception:
+                traceback.print_exc(file=log)
+                status = 1
+        result = {'name': name, 'manifest': json_path, 'aci': aci_path,
+                  'log': log_path, 'status': status,
+                  'elapsed': time.time() - start}
+        with lock:
+            print('{0}: {1} ({2:.1f}s, log: {3})'.format(
+                name, 'ok' if status == 0 else 'failed',
+                result['elapsed'], log_path))
+            sys.stdout.flush()
+        return result
+
+    pool = ThreadPool(max(1, min(args.jobs or multiprocessing.cpu_count(),
+                                 len(jobs))))
+    try:
+        results = pool.map(run, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    with open(os.path.join(log_dir, 'status.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+    failed = [x['name'] for x in results if x['status']]
+    if failed:
+        print('{0} of {1} builds failed: {2}'.format(
+            len(failed), len(results), ', '.join(failed)))
+    return 1 if failed else 0
+
+
+def _open_aci(aci_path):
+    if os.path.exists(aci_path + '.index'):
+        return AciIndex(aci_path)
+    sys.stderr.write('{0}.index is not found; reading the whole archive\n'
+                     .format(aci_path))
+    return _open_aci_stream(aci_path)
+
+
+def _open_aci_stream(aci_path):
+    with open(aci_path, 'rb') as f:
+        magic = f.read(6)
+    if magic.startswith(b'\x1f\x8b'):
+        fileobj = gzip.open(aci_path, 'rb')
+    elif magic.startswith(b'\xfd7zXZ\x00'):
+        fileobj = lzma.open(aci_path, 'rb')
+    elif magic.startswith(b'BZh'):
+        fileobj = bz2.BZ2File(aci_path, 'rb')
+    elif magic.startswith(b'\x28\xb5\x2f\xfd'):
+        fileobj = zstandard.ZstdDecompressor().stream_reader(
+            open(aci_path, 'rb'), read_across_frames=True, closefd=True)
+    elif magic.startswith(b'\x04\x22\x4d\x18'):
+        fileobj = lz4.frame.open(aci_path, 'rb')
+    else:
+        fileobj = open(aci_path, 'rb')
+    return tarfile.open(fileobj=fileobj, mode='r|')
+
+
+def _member_name(name):
+    name = name.strip('/')
+    if name == 'manifest' or name == 'rootfs' or name.startswith('rootfs/'):
+        return name
+    return 'rootfs/' + name
+
+
+def inspect_aci(argv):
+    parser = argparse.ArgumentParser(
+        prog='acipacker.py inspect',
+        description='Show the manifest or the members of an ACI')
+    parser.add_argument('--list', '-l', action='store_true',
+                        help='list the archive members instead of '
+                        'printing the manifest')
+    parser.add_argument('aci_path', action='store', help='aci path')
+    args = parser.parse_args(argv)
+    aci = _open_aci(args.aci_path)
+    try:
+        if isinstance(aci, AciIndex):
+            if args.list:
+                for name in aci.names:
+                    print('{0:>12} {1}'.format(aci.members[name][2], name))
+                return 0
+            tar, info = aci.member('manifest')
+            sys.stdout.write(tar.extractfile(info).read().decode('utf-8'))
+            sys.stdout.write('\n')
+            return 0
+        for info in aci:
+            if args.list:
+                print('{0:>12} {1}'.format(info.size, info.name))
+            elif info.name == 'manifest':
+                sys.stdout.write(aci.extractfile(info).read().decode('utf-8'))
+                sys.stdout.write('\n')
+                return 0
+        return 0
+    finally:
+        aci.close()
+
+
+def extract_aci(argv):
+    parser = argparse.ArgumentParser(
+        prog='acipacker.py extract',
+        description='Extract the manifest or rootfs files from an ACI')
+    parser.add_argument('--output-dir', '-o', action='store', default='.',
+                        help='extraction directory (default: .)')
+    parser.add_argument('--stdout', '-O', action='store_true',
+                        help='write the file contents to stdout')
+    parser.add_argument('aci_path', action='store', help='aci path')
+    parser.add_argument('members', nargs='+',
+                        help='"manifest", or rootfs paths such as /etc/hosts')
+    args = parser.parse_args(argv)
+    names = [_member_name(x) for x in args.members]
+    kwargs = {'filter': 'fully_trusted'} if hasattr(
+        tarfile, 'fully_trusted_filter') else {}
+    def emit(tar, info):
+        if args.stdout:
+            if info.isreg():
+                sys.stdout.flush()
+                shutil.copyfileobj(tar.extractfile(info), getattr(
+                    sys.stdout, 'buffer', sys.stdout))
+        else:
+            tar.extract(info, args.output_dir, **kwargs)
+    aci = _open_aci(args.aci_path)
+    try:
+        if isinstance(aci, AciIndex):
+            for name in names:
+                emit(*aci.member(name))
+            return 0
+        wanted, links = set(names), {}
+        aliases = collections.defaultdict(list)
+        for info in aci:
+            if info.islnk():
+                links[info.name] = info.linkname
+            if info.name not in wanted:
+                continue
+            wanted.discard(info.name)
+            if info.islnk():
+                target = info.linkname
+                while target in links:
+                    target = links[target]
+                aliases[target].append(info.name)
+            else:
+                emit(aci, info)
+        if wanted:
+            raise KeyError('{0} is not found in {1}'.format(
+                ', '.join(sorted(wanted)), args.aci_path))
+        if not aliases:
+            return 0
+        aci.close()
+        aci = _open_aci_stream(args.aci_path)
+        for info in aci:
+            if info.name not in aliases:
+                continue
+            extracted = None
+            if args.stdout and info.isreg():
+                with tempfile.TemporaryFile() as spool:
+                    shutil.copyfileobj(aci.extractfile(info), spool)
+                    for name in aliases.pop(info.name):
+                        spool.seek(0)
+                        sys.stdout.flush()
+                        shutil.copyfileobj(spool, getattr(
+                            sys.stdout, 'buffer', sys.stdout))
+            elif args.stdout:
+                aliases.pop(info.name)
+            for name in aliases.pop(info.name, []):
+                path = os.path.join(args.output_dir, name)
+                if extracted is None:
+                    link = copy.copy(info)
+                    link.name = name
+                    emit(aci, link)
+                    extracted = path
+                else:
+                    _makedirs(os.path.dirname(path))
+                    shutil.copy2(extracted, path)
+            if not aliases:
+                break
+        if aliases:
+            raise KeyError('link target {0} is not found in {1}'.format(
+                ', '.join(sorted(aliases)), args.aci_path))
+        return 0
+    finally:
+        aci.close()
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'build-many':
+        sys.exit(build_many(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'inspect':
+        sys.exit(inspect_aci(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'extract':
+        sys.exit(extract_aci(sys.argv[2:]))
+    parser = argparse.ArgumentParser(description='App container image builder')
+    _add_build_arguments(parser)
+    parser.add_argument('--jobs', '-j', action='store', type=int,
+                        default=None, dest='copy_jobs',
+                        help='number of parallel workers used by copy steps '
+                        '(default: number of CPUs)')
+    parser.add_argument('--trace', action='store', default=None,
+                        metavar='FILE',
+                        help='write a per-step timeline to FILE')
+    parser.add_argument('--trace-format', action='store', default='jsonl',
+                        choices=('jsonl', 'chrome'),
+                        help='trace output format: JSON lines or Chrome '
+                        'trace events (default: jsonl)')
+    parser.add_argument('--base-aci', action='store', default=None,
+                        metavar='PATH',
+                        help='output path of the base layer ACI '
+                        '(default: <aci_path without .aci>-base.aci)')
+    parser.add_argument('--base-name', action='store', default=None,
+                        help='image name of the base layer '
+                        '(default: <name>-base)')
+    parser.add_argument('--step-log-dir', action='store', default=None,
+                        metavar='DIR',
+                        help='directory of per-step output logs '
+                        '(default: under <cache-dir>/logs)')
     parser.add_argument('json_path', action='store', type=str,
                         help='manifest(json) path')
     parser.add_argument('aci_path', action='store', type=str,
@@ -503,9 +3110,16 @@ def main():
     if not os.path.isfile(args.json_path):
         raise FileNotFoundError('{0} is not found\n'.format(args.json_path))
 
-    builder = Builder()
-    builder.build_aci(args.json_path, args.aci_path,
-                      args.compression, args.debug)
+    builder = Builder(tracer=Tracer(args.trace, args.trace_format),
+                      **_builder_kwargs(args))
+    try:
+        builder.build_aci(args.json_path, args.aci_path,
+                          args.compression, args.debug,
+                          layer_after=args.layer_after,
+                          base_aci=args.base_aci, base_name=args.base_name,
+                          step_log_dir=args.step_log_dir)
+    finally:
+        builder.tracer.write()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import os.path
+import platform
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+import acipacker
+
+HOST_BINARIES = ['/bin/bash', '/bin/ls', '/bin/cat', '/bin/tar', '/bin/gzip',
+                 '/usr/bin/env', '/usr/bin/find', '/usr/bin/xz']
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Scenario(object):
+    def __init__(self, name, func, needs_root=False):
+        self.name = name
+        self.func = func
+        self.needs_root = needs_root
+
+
+def make_tree(root, files, depth, size, seed=0):
+    rnd = random.Random(seed)
+    dirs = [root]
+    for i in range(depth):
+        d = os.path.join(dirs[-1], 'd{0}'.format(i))
+        os.makedirs(d)
+        dirs.append(d)
+    total = 0
+    for i in range(files):
+        path = os.path.join(rnd.choice(dirs), 'f{0}.txt'.format(i))
+        with open(path, 'wb') as f:
+            data = (('{0} '.format(i) * (size // 8 + 1))[:size]).encode()
+            f.write(data)
+        total += size
+    return total
+
+
+def make_elf_tree(root, binaries):
+    hosts = [x for x in HOST_BINARIES if os.path.isfile(x)]
+    os.makedirs(root)
+    for i in range(binaries):
+        src = hosts[i % len(hosts)]
+        shutil.copy2(src, os.path.join(
+            root, '{0}-{1}'.format(os.path.basename(src), i)))
+
+
+def make_tarball(path, tree):
+    with tarfile.open(path, 'w:gz') as tar:
+        tar.add(tree, arcname='.')
+
+
+def make_builder(workdir, **kwargs):
+    kwargs.setdefault('cache_dir', os.path.join(workdir, 'cache'))
+    kwargs.setdefault('step_cache', False)
+    kwargs.setdefault('base_cache', 'off')
+    builder = acipacker.Builder(**kwargs)
+    builder.debug = False
+    builder.basedir = workdir
+    builder.workdir = tempfile.mkdtemp(dir=workdir)
+    builder.rootfs = os.path.join(builder.workdir, 'rootfs')
+    os.mkdir(builder.rootfs, 0o755)
+    return builder
+
+
+def discard_builder(builder):
+    builder._cleanup(unmount_rootfs=True)
+    shutil.rmtree(builder.workdir)
+
+
+class Bench(object):
+    def __init__(self, args):
+        self.args = args
+        self.datadir = tempfile.mkdtemp(prefix='aci-bench-')
+        self.tree = os.path.join(self.datadir, 'tree')
+        self.elf_tree = os.path.join(self.datadir, 'elf')
+        self.tarball = os.path.join(self.datadir, 'www', 'rootfs.tar.gz')
+        os.makedirs(os.path.dirname(self.tarball))
+        self.tree_bytes = make_tree(self.tree, args.files, args.depth,
+                                    args.file_size)
+        make_elf_tree(self.elf_tree, args.binaries)
+        make_tarball(self.tarball, self.tree)
+        self.server = None
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        shutil.rmtree(self.datadir)
+
+    def url(self):
+        if self.server is None:
+            www = os.path.dirname(self.tarball)
+            class Handler(QuietHandler):
+                def translate_path(self, path):
+                    return os.path.join(www, os.path.basename(path))
+            self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+            thread = threading.Thread(target=self.server.serve_forever)
+            thread.daemon = True
+            thread.start()
+        return 'http://127.0.0.1:{0}/rootfs.tar.gz'.format(
+            self.server.server_address[1])
+
+    def run(self, func):
+        workdir = tempfile.mkdtemp(dir=self.datadir)
+        try:
+            return func(workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def image_path(self, workdir):
+        builder = make_builder(workdir)
+        try:
+            start = time.time()
+            builder.step_image(path=self.tarball)
+            return time.time() - start
+        finally:
+            discard_builder(builder)
+
+    def image_url(self, workdir):
+        url = self.url()
+        builder = make_builder(workdir)
+        try:
+            start = time.time()
+            builder.step_image(url=url)
+            return time.time() - start
+        finally:
+            discard_builder(builder)
+
+    def image_url_cached(self, workdir):
+        url = self.url()
+        make_builder(workdir).download_cache.fetch(url)
+        builder = make_builder(workdir)
+        try:
+            start = time.time()
+            builder.step_image(url=url)
+            return time.time() - start
+        finally:
+            discard_builder(builder)
+
+    def image_base_overlay(self, workdir):
+        builder = make_builder(workdir, base_cache='overlay')
+        builder.step_image(path=self.tarball)
+        discard_builder(builder)
+        builder = make_builder(workdir, base_cache='overlay')
+        try:
+            start = time.time()
+            builder.step_image(path=self.tarball)
+            return time.time() - start
+        finally:
+            discard_builder(builder)
+
+    def copy_find_executable(self, workdir):
+        builder = make_builder(workdir, jobs=self.args.jobs)
+        try:
+            start = time.time()
+            builder.step_copy(find_executable=[self.elf_tree])
+            return time.time() - start
+        finally:
+            discard_builder(builder)
+
+    def copy_find_executable_ldd(self, workdir):
+        builder = make_builder(workdir, jobs=self.args.jobs, resolver='ldd')
+        try:
+            start = time.time()
+            builder.step_copy(find_executable=[self.elf_tree])
+            return time.time() - start
+        finally:
+            discard_builder(builder)
+
+    def copy_files(self, workdir):
+        builder = make_builder(workdir, jobs=self.args.jobs)
+        try:
+            start = time.time()
+            builder.step_copy(files=[[self.tree, '/data']])
+            return time.time() - start
+        finally:
+            discard_builder(builder)
+
+    def copytree_overwrite(self, workdir):
+        builder = make_builder(workdir, jobs=self.args.jobs)
+        try:
+            start = time.time()
+            builder._copytree_overwrite(self.tree,
+                                        os.path.join(builder.rootfs, 'data'))
+            return time.time() - start
+        finally:
+            discard_builder(builder)
+
+    def cmd_chroot(self, workdir):
+        builder = make_builder(workdir)
+        try:
+            builder.step_copy(binaries=['/bin/true'])
+            start = time.time()
+            builder.step_cmd(path='/bin/true')
+            return time.time() - start
+        finally:
+            discard_builder(builder)
+
+    def compress(self, compression):
+        def run(workdir):
+            builder = make_builder(workdir, threads=self.args.threads)
+            try:
+                builder._copytree_overwrite(
+                    self.tree, os.path.join(builder.rootfs, 'data'))
+                start = time.time()
+                builder._write_aci(os.path.join(workdir, 'out.aci'),
+                                   {'name': 'bench'}, compression)
+                return time.time() - start
+            finally:
+                discard_builder(builder)
+        return run
+
+    def scenarios(self):
+        scenarios = [
+            Scenario('image_path', self.image_path),
+            Scenario('image_url', self.image_url),
+            Scenario('image_url_cached', self.image_url_cached),
+            Scenario('image_base_overlay', self.image_base_overlay,
+                     needs_root=True),
+            Scenario('copy_find_executable', self.copy_find_executable),
+            Scenario('copy_find_executable_ldd',
+                     self.copy_find_executable_ldd),
+            Scenario('copy_files', self.copy_files),
+            Scenario('copytree_overwrite', self.copytree_overwrite),
+            Scenario('cmd_chroot', self.cmd_chroot, needs_root=True),
+        ]
+        for name in sorted(acipacker.COMPRESSION_TYPE):
+            scenarios.append(Scenario('compress_' + name,
+                                      self.compress(name)))
+        return scenarios
+
+
+def summarize(times):
+    times = sorted(times)
+    return {
+        'times': times,
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'mean': sum(times) / len(times),
+    }
+
+
+def run_benchmarks(args):
+    bench = Bench(args)
+    results = {}
+    try:
+        for scenario in bench.scenarios():
+            if args.only and scenario.name not in args.only:
+                continue
+            if scenario.needs_root and (os.geteuid() != 0 or
+                                        args.unprivileged):
+                print('{0}: skipped (requires root)'.format(scenario.name))
+                results[scenario.name] = {'skipped': 'requires root'}
+                continue
+            times = []
+            try:
+                for i in range(args.repeat):
+                    times.append(bench.run(scenario.func))
+            except Exception as e:
+                print('{0}: failed ({1})'.format(scenario.name, e))
+                results[scenario.name] = {'error': str(e)}
+                continue
+            results[scenario.name] = summarize(times)
+            print('{0}: {1:.3f}s (median of {2})'.format(
+                scenario.name, results[scenario.name]['median'], len(times)))
+    finally:
+        bench.close()
+    return {
+        'meta': {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': acipacker.multiprocessing.cpu_count(),
+            'files': args.files, 'depth': args.depth,
+            'file_size': args.file_size, 'binaries': args.binaries,
+            'jobs': args.jobs, 'threads': args.threads,
+            'repeat': args.repeat,
+            'tree_bytes': bench.tree_bytes,
+        },
+        'results': results,
+    }
+
+
+def compare(old_path, new_path, threshold):
+    with open(old_path) as f:
+        old = json.load(f)['results']
+    with open(new_path) as f:
+        new = json.load(f)['results']
+    regressions = 0
+    for name in sorted(set(old) | set(new)):
+        a, b = old.get(name, {}), new.get(name, {})
+        if 'median' not in a or 'median' not in b:
+            print('{0:30s} {1:>10s} {2:>10s}'.format(
+                name, 'median' in a and '{0:.3f}'.format(a['median']) or '-',
+                'median' in b and '{0:.3f}'.format(b['median']) or '-'))
+            continue
+        ratio = b['median'] / a['median'] if a['median'] else float('inf')
+        mark = ''
+        if ratio > 1 + threshold:
+            mark = ' REGRESSION'
+            regressions += 1
+        print('{0:30s} {1:10.3f} {2:10.3f} {3:7.2f}x{4}'.format(
+            name, a['median'], b['median'], ratio, mark))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='aci-packer benchmark')
+    parser.add_argument('--files', type=int, default=2000,
+                        help='number of files in the synthetic tree')
+    parser.add_argument('--depth', type=int, default=8,
+                        help='directory depth of the synthetic tree')
+    parser.add_argument('--file-size', type=int, default=4096,
+                        help='size of each synthetic file in bytes')
+    parser.add_argument('--binaries', type=int, default=200,
+                        help='number of ELF binaries in the executable tree')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='copy step workers')
+    parser.add_argument('--threads', '-T', type=int, default=None,
+                        help='compression threads')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per scenario (default: 3)')
+    parser.add_argument('--only', action='append', default=[],
+                        help='run only the named scenario (repeatable)')
+    parser.add_argument('--unprivileged', action='store_true',
+                        help='skip scenarios that require root')
+    parser.add_argument('--output', '-o', default=None,
+                        help='write results as JSON to this path')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files instead of running')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown reported as a regression '
+                        'by --compare (default: 0.1)')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1],
+                              args.threshold) else 0)
+    result = run_benchmarks(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()